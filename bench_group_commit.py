@@ -0,0 +1,70 @@
+"""
+Бенчмарк записи: коммит на каждую операцию vs group commit.
+
+Имитирует наплыв новых пользователей (после поста у спонсора): много
+корутин одновременно вызывают user_repo.ensure() — INSERT в users плюс
+счётчики статистики, как в боте.
+
+Запуск:
+    python bench_group_commit.py                 # 5000 юзеров, 200 одновременно
+    python bench_group_commit.py -n 20000 -c 500
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+import bot
+
+
+async def run(path: str, n: int, concurrency: int, batch_max: int, window_ms: float) -> dict:
+    bot.init_schema(path)
+    db = bot.Database(path, batch_max=batch_max, batch_window_ms=window_ms)
+    users = bot.UserRepo(db)
+    latencies: list[float] = []
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(tg_id: int):
+        async with sem:
+            t0 = time.perf_counter()
+            await users.ensure(tg_id, f"user{tg_id}", "bench")
+            latencies.append(time.perf_counter() - t0)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(10_000_000 + i) for i in range(n)))
+    elapsed = time.perf_counter() - started
+    db.close()
+
+    latencies.sort()
+    return {
+        "ops_s": n / elapsed,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        "elapsed_s": elapsed,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("-n", type=int, default=5000, help="сколько пользователей вставить")
+    parser.add_argument("-c", type=int, default=200, help="сколько корутин пишут одновременно")
+    parser.add_argument("--batch-max", type=int, default=bot.DB_BATCH_MAX)
+    parser.add_argument("--window-ms", type=float, default=bot.DB_BATCH_WINDOW_MS)
+    args = parser.parse_args()
+
+    modes = [
+        ("per-op commit", 1, 0),
+        (f"group commit (≤{args.batch_max}, {args.window_ms} ms)", args.batch_max, args.window_ms),
+    ]
+    print(f"{args.n} inserts, concurrency {args.c}\n")
+    print(f"{'mode':<36}{'ops/s':>10}{'p50 ms':>10}{'p99 ms':>10}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for i, (name, batch_max, window) in enumerate(modes):
+            res = await run(os.path.join(tmp, f"bench{i}.db"), args.n, args.c, batch_max, window)
+            print(f"{name:<36}{res['ops_s']:>10.0f}{res['p50_ms']:>10.2f}{res['p99_ms']:>10.2f}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
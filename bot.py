@@ -54,25 +54,54 @@ MIN_WITHDRAW=100    # минималка на вывод в Gold
 Дальше можно добавить: «вступить в чат», «репост», «просмотр поста по кнопке», «рефералку», «Telegram Stars» и т.д.
 
 """
+import argparse
 import asyncio
+import copy
+import heapq
+import itertools
+import json
 import logging
+import multiprocessing
 import os
+import queue
+import signal
 import sqlite3
+import threading
+import time
+import zlib
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, closing, contextmanager
+from contextvars import ContextVar
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import datetime, timedelta
+from enum import IntEnum
+from typing import Any, Callable, Mapping, NamedTuple, TypeVar
 
-from aiogram import Bot, Dispatcher, F, Router
+from aiogram import BaseMiddleware, Bot, Dispatcher, F, Router
+from aiohttp import ClientConnectorError, ClientError, ClientSession, UnixConnector, web
 from aiogram.filters import CommandStart, Command
 from aiogram.types import (
     Message,
     CallbackQuery,
+    ChatMember,
+    ChatMemberUpdated,
+    Update,
     InlineKeyboardMarkup,
     InlineKeyboardButton,
 )
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.fsm.context import FSMContext
-from aiogram.exceptions import TelegramBadRequest
+from aiogram.fsm.storage.base import BaseEventIsolation, BaseStorage, DefaultKeyBuilder, StateType, StorageKey
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
 from dotenv import load_dotenv
 
 # ====================
@@ -82,21 +111,217 @@ load_dotenv()
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 OWNER_ID = int(os.getenv("OWNER_ID", "0"))
 MIN_WITHDRAW = int(os.getenv("MIN_WITHDRAW", "100"))
+# Сколько getChatMember может висеть одновременно на весь бот
+MEMBER_CHECK_CONCURRENCY = int(os.getenv("MEMBER_CHECK_CONCURRENCY", "16"))
+# Кэш getChatMember: TTL в секундах для «подписан» / «не подписан»
+MEMBER_CACHE_SIZE = int(os.getenv("MEMBER_CACHE_SIZE", "100000"))
+MEMBER_CACHE_POS_TTL = float(os.getenv("MEMBER_CACHE_POS_TTL", "120"))
+MEMBER_CACHE_NEG_TTL = float(os.getenv("MEMBER_CACHE_NEG_TTL", "5"))
+# «Не подписан» моложе стольких секунд верим даже на кнопке «Проверить»:
+# повторные тапы, ждавшие первый, не делают свой getChatMember
+MEMBER_RECHECK_AFTER = float(os.getenv("MEMBER_RECHECK_AFTER", "2"))
+ADMIN_CACHE_CHECK_EVERY = float(os.getenv("ADMIN_CACHE_CHECK_EVERY", "5"))
+CATALOG_CHECK_EVERY = float(os.getenv("CATALOG_CHECK_EVERY", "1"))
+# Антифлуд колбэков: "префикс=токенов_в_сек/burst" через запятую
+THROTTLE_RULES = os.getenv("THROTTLE_RULES", "task_check:=0.5/3,check_sponsors=0.5/3,tasks=1/5")
+THROTTLE_GLOBAL = os.getenv("THROTTLE_GLOBAL", "50/100")  # на все колбэки из правил вместе
+THROTTLE_IDLE_TTL = float(os.getenv("THROTTLE_IDLE_TTL", "120"))
+# Исходящие запросы: глобальный лимит Telegram ~30 msg/s, в один чат — ~1 msg/s
+OUTBOUND_RATE = float(os.getenv("OUTBOUND_RATE", "28"))
+OUTBOUND_CHAT_RATE = os.getenv("OUTBOUND_CHAT_RATE", "1/5")  # токенов_в_сек/burst
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))
+BROADCAST_BATCH = int(os.getenv("BROADCAST_BATCH", "200"))
+BROADCAST_REPORT_EVERY = float(os.getenv("BROADCAST_REPORT_EVERY", "5"))
+BROADCAST_POLL = float(os.getenv("BROADCAST_POLL", "2"))  # как быстро основной процесс видит рассылки из других воркеров
+# Списки в админке: строк на страницу (пагинация по id, без OFFSET)
+ADMIN_PAGE_SIZE = int(os.getenv("ADMIN_PAGE_SIZE", "10"))
+TASKS_PAGE_SIZE = int(os.getenv("TASKS_PAGE_SIZE", "8"))  # то же для ленты заданий юзера
+# Outbox уведомлений о выводах: пачка, опрос при простое, попытки до отметки failed
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "50"))
+OUTBOX_POLL = float(os.getenv("OUTBOX_POLL", "5"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+# Перепроверка выполненных подписок: пауза между проходами (0 = выкл), пачка,
+# свой лимит getChatMember ("в_сек/burst") и параллельность, списывать ли награду
+VERIFY_INTERVAL = float(os.getenv("VERIFY_INTERVAL", str(6 * 3600)))
+VERIFY_BATCH = int(os.getenv("VERIFY_BATCH", "100"))
+VERIFY_RATE = os.getenv("VERIFY_RATE", "5/10")
+VERIFY_CONCURRENCY = int(os.getenv("VERIFY_CONCURRENCY", "4"))
+VERIFY_CLAWBACK = os.getenv("VERIFY_CLAWBACK", "0") == "1"
+# Webhook-режим (python bot.py --mode webhook)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный адрес, напр. https://my-bot.onrender.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_MAX_INFLIGHT = int(os.getenv("WEBHOOK_MAX_INFLIGHT", "64"))
+WEBHOOK_DRAIN_TIMEOUT = float(os.getenv("WEBHOOK_DRAIN_TIMEOUT", "25"))
+HOST = os.getenv("HOST", "0.0.0.0")
+PORT = int(os.getenv("PORT", "8080"))
+# FSM в SQLite: кэш в памяти, сброс на диск пачками, брошенные диалоги живут FSM_TTL секунд
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "50000"))
+FSM_FLUSH_INTERVAL = float(os.getenv("FSM_FLUSH_INTERVAL", "0.5"))
+FSM_TTL = float(os.getenv("FSM_TTL", str(24 * 3600)))
+# /metrics (формат Prometheus): в webhook-режиме — на том же сервере, в polling — на METRICS_PORT (0 = выкл)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Supervisor-режим (python bot.py --mode supervisor): WORKERS процессов за одним webhook
+WORKERS = int(os.getenv("WORKERS", str(os.cpu_count() or 2)))
+CLUSTER_DIR = os.getenv("CLUSTER_DIR", "/tmp/tgbot-cluster")  # unix-сокеты воркеров и координатора
+RATE_LEASE = int(os.getenv("RATE_LEASE", "4"))  # глобальных токенов Bot API за один запрос к координатору
 
 logging.basicConfig(level=logging.INFO)
 
+T = TypeVar("T")
+
+# ====================
+# METRICS
+# ====================
+# Текстовый формат Prometheus без внешних зависимостей. Метрики меняются
+# только из event loop (потоки БД меряются со стороны await), поэтому без локов.
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple[str, ...], values: tuple, le: str | None = None) -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if le is not None:
+        pairs.append(f'le="{le}"')
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class MetricCounter:
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.values: dict[tuple, float] = {}
+
+    def inc(self, *label_values, amount: float = 1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, doc: str, labels: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.doc = doc
+        self.labels = labels
+        self.buckets = buckets
+        self.series: dict[tuple, list] = {}  # labels → [счётчики по бакетам..., sum, count]
+
+    def observe(self, value: float, *label_values):
+        s = self.series.get(label_values)
+        if s is None:
+            s = self.series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                s[i] += 1
+        s[-2] += value
+        s[-1] += 1
+
+    @contextmanager
+    def time(self, *label_values):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *label_values)
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} histogram"]
+        for key, s in sorted(self.series.items()):
+            for bound, n in zip(self.buckets, s):
+                lines.append(f"{self.name}_bucket{_labels(self.labels, key, str(bound))} {n}")
+            lines.append(f"{self.name}_bucket{_labels(self.labels, key, '+Inf')} {s[-1]}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {s[-2]}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {s[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """Постоянные метрики + коллекторы: async-функции, которые на каждый
+    scrape отдают гейджи как [(имя, doc, {labels: value})]."""
+
+    def __init__(self):
+        self.metrics: list[MetricCounter | Histogram] = []
+        self.collectors: list[Callable[[], Any]] = []
+
+    def counter(self, name: str, doc: str, labels: tuple[str, ...] = ()) -> MetricCounter:
+        m = MetricCounter(name, doc, labels)
+        self.metrics.append(m)
+        return m
+
+    def histogram(self, name: str, doc: str, labels: tuple[str, ...] = ()) -> Histogram:
+        m = Histogram(name, doc, labels)
+        self.metrics.append(m)
+        return m
+
+    def collector(self, fn: Callable[[], Any]):
+        self.collectors.append(fn)
+        return fn
+
+    async def render(self) -> str:
+        lines = []
+        for m in self.metrics:
+            lines += m.render()
+        for fn in self.collectors:
+            try:
+                gauges = await fn()
+            except Exception as e:
+                logging.warning("metrics: collector %s failed: %r", fn.__name__, e)
+                continue
+            for name, doc, label_name, values in gauges:
+                lines += [f"# HELP {name} {doc}", f"# TYPE {name} gauge"]
+                for key, value in sorted(values.items(), key=lambda kv: str(kv[0])):
+                    labels = _labels((label_name,), (key,)) if label_name else ""
+                    lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+handler_seconds = metrics.histogram("bot_handler_seconds", "Время обработки апдейта хендлером", ("handler",))
+handler_errors = metrics.counter("bot_handler_errors_total", "Исключения из хендлеров", ("handler", "error"))
+db_seconds = metrics.histogram("bot_db_seconds", "Время операции с БД, включая ожидание потока/пачки", ("kind",))
+db_errors = metrics.counter("bot_db_errors_total", "Ошибки операций с БД", ("kind",))
+api_seconds = metrics.histogram("bot_api_request_seconds", "Латентность одного запроса к Bot API", ("method",))
+api_errors = metrics.counter("bot_api_errors_total", "Ошибки запросов к Bot API (каждая попытка)", ("method", "error"))
+
 # ====================
 # DB
 # ====================
 DB_PATH = "bot.db"
-conn = sqlite3.connect(DB_PATH, check_same_thread=False)
-conn.row_factory = sqlite3.Row
-cur = conn.cursor()
-
-cur.executescript(
-    """
-    PRAGMA journal_mode=WAL;
-
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+# Group commit: записи копятся до DB_BATCH_MAX штук или DB_BATCH_WINDOW_MS и коммитятся одной транзакцией
+DB_BATCH_MAX = int(os.getenv("DB_BATCH_MAX", "256"))
+DB_BATCH_WINDOW_MS = float(os.getenv("DB_BATCH_WINDOW_MS", "2"))
+# PRAGMA каждого соединения. synchronous=NORMAL в WAL быстрее, но коммиты последних
+# мгновений могут пропасть при падении ОС (не процесса); по умолчанию — FULL, как было.
+DB_PRAGMAS = {
+    "synchronous": os.getenv("DB_SYNCHRONOUS", "FULL"),
+    "cache_size": -int(os.getenv("DB_CACHE_SIZE_KB", "8192")),  # page cache на соединение, KiB
+    "mmap_size": int(os.getenv("DB_MMAP_SIZE", str(256 * 2**20))),  # 0 = читать через read()
+    "temp_store": os.getenv("DB_TEMP_STORE", "MEMORY"),
+    "journal_size_limit": int(os.getenv("DB_JOURNAL_SIZE_LIMIT", str(64 * 2**20))),  # WAL после checkpoint — не больше
+    "analysis_limit": int(os.getenv("DB_ANALYSIS_LIMIT", "1000")),  # строк на индекс в ANALYZE из PRAGMA optimize
+}
+# Обслуживание БД (DbMaintenance): проверка раз в DB_MAINT_INTERVAL с (0 = выкл);
+# checkpoint, когда WAL больше порога; PRAGMA optimize; чистка outbox; incremental_vacuum порциями
+DB_MAINT_INTERVAL = float(os.getenv("DB_MAINT_INTERVAL", "60"))
+DB_WAL_CHECKPOINT_BYTES = int(os.getenv("DB_WAL_CHECKPOINT_BYTES", str(32 * 2**20)))
+DB_CHECKPOINT_MODE = os.getenv("DB_CHECKPOINT_MODE", "TRUNCATE")  # PASSIVE — никого не ждёт, TRUNCATE — ещё и обнуляет файл
+DB_OPTIMIZE_INTERVAL = float(os.getenv("DB_OPTIMIZE_INTERVAL", str(6 * 3600)))
+DB_VACUUM_PAGES = int(os.getenv("DB_VACUUM_PAGES", "2000"))  # страниц за один incremental_vacuum, 0 = выкл
+DB_VACUUM_MIN_FREE = int(os.getenv("DB_VACUUM_MIN_FREE", "1000"))  # запускать, если свободных страниц больше
+OUTBOX_KEEP_DAYS = float(os.getenv("OUTBOX_KEEP_DAYS", "7"))  # отправленные уведомления старше — удаляются, 0 = хранить
+
+# Схема на момент появления миграций (версия 1). Дальше её не правим —
+# изменения добавляются новыми шагами в MIGRATIONS.
+SCHEMA = """
     CREATE TABLE IF NOT EXISTS users (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         tg_id INTEGER UNIQUE NOT NULL,
@@ -133,7 +358,7 @@ cur.executescript(
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         user_id INTEGER NOT NULL,
         task_id INTEGER NOT NULL,
-        status TEXT DEFAULT 'new', -- new/done/rejected
+        status TEXT DEFAULT 'new', -- new/done/rejected/left (отписался после зачёта)
         checked_at TEXT,
         UNIQUE(user_id, task_id)
     );
@@ -160,45 +385,1230 @@ cur.executescript(
         key TEXT PRIMARY KEY,
         value TEXT
     );
+
+    -- любая правка admins двигает версию, AdminCache по ней перечитывает список
+    CREATE TRIGGER IF NOT EXISTS trg_admins_ins AFTER INSERT ON admins BEGIN
+        INSERT INTO settings (key, value) VALUES ('admins_version', 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_admins_upd AFTER UPDATE ON admins BEGIN
+        INSERT INTO settings (key, value) VALUES ('admins_version', 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_admins_del AFTER DELETE ON admins BEGIN
+        INSERT INTO settings (key, value) VALUES ('admins_version', 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1;
+    END;
+
+    -- то же для каталога: воркеры supervisor-режима видят правки соседей
+    CREATE TRIGGER IF NOT EXISTS trg_sponsors_ins AFTER INSERT ON sponsors BEGIN
+        INSERT INTO settings (key, value) VALUES ('catalog_version', 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_sponsors_upd AFTER UPDATE ON sponsors BEGIN
+        INSERT INTO settings (key, value) VALUES ('catalog_version', 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_sponsors_del AFTER DELETE ON sponsors BEGIN
+        INSERT INTO settings (key, value) VALUES ('catalog_version', 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_tasks_ins AFTER INSERT ON tasks BEGIN
+        INSERT INTO settings (key, value) VALUES ('catalog_version', 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_tasks_upd AFTER UPDATE ON tasks BEGIN
+        INSERT INTO settings (key, value) VALUES ('catalog_version', 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1;
+    END;
+    CREATE TRIGGER IF NOT EXISTS trg_tasks_del AFTER DELETE ON tasks BEGIN
+        INSERT INTO settings (key, value) VALUES ('catalog_version', 1)
+        ON CONFLICT(key) DO UPDATE SET value = value + 1;
+    END;
+
+    CREATE TABLE IF NOT EXISTS broadcasts (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        text TEXT NOT NULL,
+        admin_chat_id INTEGER,
+        progress_message_id INTEGER,
+        last_user_id INTEGER DEFAULT 0, -- курсор по users.id
+        total INTEGER DEFAULT 0,
+        sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0,
+        blocked INTEGER DEFAULT 0,
+        status TEXT DEFAULT 'running', -- running/done
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        finished_at TEXT
+    );
+
+    -- горячие запросы статистики и списка выводов
+    CREATE INDEX IF NOT EXISTS idx_users_joined_at ON users(joined_at);
+    CREATE INDEX IF NOT EXISTS idx_user_tasks_task_status ON user_tasks(task_id, status);
+    CREATE INDEX IF NOT EXISTS idx_withdrawals_status_id ON withdrawals(status, id);
+    -- перепроверка подписок идёт от свежих зачётов к старым
+    CREATE INDEX IF NOT EXISTS idx_user_tasks_status_checked ON user_tasks(status, checked_at, id);
+    -- лента заданий: активные по убыванию id, выполненные отсекает UNIQUE(user_id, task_id)
+    CREATE INDEX IF NOT EXISTS idx_tasks_active_id ON tasks(active, id);
+
+    CREATE TABLE IF NOT EXISTS fsm_state (
+        key TEXT PRIMARY KEY,
+        state TEXT,
+        data TEXT, -- JSON
+        updated_at REAL NOT NULL -- unix time
+    );
+    CREATE INDEX IF NOT EXISTS idx_fsm_state_updated_at ON fsm_state(updated_at);
+
+    -- счётчики для /admin → Статистика, обновляются в тех же транзакциях, что и данные
+    CREATE TABLE IF NOT EXISTS stats_counters (
+        key TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    );
+
+    CREATE TABLE IF NOT EXISTS stats_daily (
+        day TEXT NOT NULL, -- YYYY-MM-DD (UTC)
+        key TEXT NOT NULL,
+        value INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (day, key)
+    );
+
+    -- исходящие уведомления: пишутся в транзакции с изменением данных, шлёт OutboxWorker
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        dedup_key TEXT UNIQUE NOT NULL, -- напр. wd:42:approved
+        chat_id INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        status TEXT DEFAULT 'pending', -- pending/sent/failed
+        attempts INTEGER DEFAULT 0,
+        next_attempt_at REAL DEFAULT 0, -- unix time
+        last_error TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        sent_at TEXT
+    );
+    CREATE INDEX IF NOT EXISTS idx_outbox_status_next ON outbox(status, next_attempt_at);
+
+    -- все начисления и списания; users.balance — снимок SUM(delta), ведётся в той же транзакции
+    CREATE TABLE IF NOT EXISTS ledger (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL, -- users.id
+        delta INTEGER NOT NULL,
+        reason TEXT NOT NULL, -- opening/task/task_clawback/withdraw/withdraw_refund/admin
+        ref_id INTEGER, -- tasks.id / withdrawals.id / tg_id админа
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS idx_ledger_user_id ON ledger(user_id, id);
+    -- одно событие (задание, заявка) — одна проводка; ручные правки админа могут повторяться
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_ledger_event ON ledger(user_id, reason, ref_id) WHERE reason != 'admin';
+
+    -- сверка идёт от контрольных точек: user_id=0 — весь журнал, иначе — один пользователь
+    CREATE TABLE IF NOT EXISTS ledger_checkpoints (
+        user_id INTEGER PRIMARY KEY,
+        last_ledger_id INTEGER NOT NULL, -- проводки до этого id включительно уже учтены
+        total INTEGER NOT NULL, -- их сумма
+        checked_at TEXT
+    );
+"""
+
+
+def _add_column(c: sqlite3.Connection, table: str, column: str, decl: str):
+    if column not in {r[1] for r in c.execute(f"PRAGMA table_info({table})")}:
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _exec_script(c: sqlite3.Connection, script: str):
+    """Как executescript, но без неявного COMMIT — шаг миграции остаётся одной транзакцией."""
+    stmt = ""
+    for line in script.splitlines(keepends=True):
+        stmt += line
+        if sqlite3.complete_statement(stmt):
+            c.execute(stmt)
+            stmt = ""
+
+
+def _m001_baseline(c: sqlite3.Connection):
+    # базы без user_version уже могут содержать часть схемы: всё IF NOT EXISTS
+    _exec_script(c, SCHEMA)
+    _add_column(c, "users", "is_blocked", "INTEGER DEFAULT 0")  # бот заблокирован юзером
+    _add_column(c, "user_tasks", "verified_at", "TEXT")  # последняя перепроверка подписки
+    # балансы, накопленные до журнала, — входящим остатком, один раз
+    if c.execute("SELECT 1 FROM ledger LIMIT 1").fetchone() is None:
+        c.execute("INSERT INTO ledger (user_id, delta, reason) SELECT id, balance, 'opening' FROM users WHERE balance != 0")
+
+
+# Шаг N переводит базу с user_version N-1 на N. Порядок не меняем, старые шаги не правим.
+MIGRATIONS: list[Callable[[sqlite3.Connection], None]] = [
+    _m001_baseline,
+]
+
+
+def migrate(c: sqlite3.Connection) -> int:
+    """Применить недостающие миграции по PRAGMA user_version, вернуть итоговую версию.
+
+    Каждый шаг — своя транзакция BEGIN IMMEDIATE, версия читается уже под
+    блокировкой: процессы, стартующие одновременно (воркеры супервизора),
+    применяют каждый шаг ровно один раз.
     """
-)
-conn.commit()
+    while True:
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            version = c.execute("PRAGMA user_version").fetchone()[0]
+            if version > len(MIGRATIONS):
+                raise RuntimeError(f"схема БД v{version} новее кода (v{len(MIGRATIONS)})")
+            if version == len(MIGRATIONS):
+                c.execute("COMMIT")
+                return version
+            MIGRATIONS[version](c)
+            c.execute(f"PRAGMA user_version = {version + 1}")
+            c.execute("COMMIT")
+        except BaseException:
+            c.execute("ROLLBACK")
+            raise
+        logging.info("DB migrated to v%s (%s)", version + 1, MIGRATIONS[version].__name__)
+
+
+def init_schema(path: str = DB_PATH):
+    """Привести базу к актуальной схеме. Вызывается из on_startup, не при импорте."""
+    with closing(sqlite3.connect(path, timeout=30, isolation_level=None)) as c:
+        # auto_vacuum меняется только на пустой базе, иначе — через VACUUM (bot.py --vacuum)
+        if DB_VACUUM_PAGES and c.execute("SELECT 1 FROM sqlite_master LIMIT 1").fetchone() is None:
+            c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        c.execute("PRAGMA journal_mode=WAL")  # вне транзакции, поэтому не в миграции
+        migrate(c)
+        # Ensure owner is admin
+        if OWNER_ID:
+            c.execute("INSERT OR IGNORE INTO admins (tg_id, role) VALUES (?, 'owner')", (OWNER_ID,))
+
+
+def _resolve(fut: asyncio.Future, ok: bool, value):
+    if fut.cancelled():
+        return
+    if ok:
+        fut.set_result(value)
+    else:
+        fut.set_exception(value)
+
+
+class Database:
+    """SQLite вне event loop.
+
+    Чтения идут в небольшой пул потоков, записи — в один выделенный поток
+    (писатель в SQLite всё равно один). У каждого потока своё соединение,
+    handlers только await'ят результат и не блокируются на диске.
+
+    Писатель делает group commit: всё, что накопилось в очереди (до batch_max
+    операций или batch_window_ms), выполняется в одной транзакции, каждая
+    операция — в своём SAVEPOINT. Ошибка одной операции откатывает только её.
+    Результат вызывающему отдаётся после COMMIT всей пачки, так что
+    durability та же, что и при коммите на каждую запись, но fsync — один на пачку.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        readers: int = DB_READERS,
+        batch_max: int = DB_BATCH_MAX,
+        batch_window_ms: float = DB_BATCH_WINDOW_MS,
+        pragmas: Mapping[str, Any] = DB_PRAGMAS,
+    ):
+        self.path = path
+        self.pragmas = dict(pragmas)
+        self.batch_max = max(1, batch_max)
+        self.batch_window = batch_window_ms / 1000
+        self._local = threading.local()
+        self._conns: list[sqlite3.Connection] = []
+        self._conns_lock = threading.Lock()
+        self._readers = ThreadPoolExecutor(max_workers=readers, thread_name_prefix="db-read")
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._writer: threading.Thread | None = None
+        self._writer_lock = threading.Lock()
+        self._optimize_gen = 0
+        self._optimize_queued = False
+
+    def _connection(self, autocommit: bool = False) -> sqlite3.Connection:
+        c = getattr(self._local, "conn", None)
+        if c is None:
+            # check_same_thread=False только ради close() из main-потока:
+            # соединением пользуется исключительно поток-владелец.
+            c = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            c.row_factory = sqlite3.Row
+            for name, value in self.pragmas.items():
+                c.execute(f"PRAGMA {name} = {value}")
+            if autocommit:
+                c.isolation_level = None  # транзакциями писателя управляем сами
+            self._local.conn = c
+            with self._conns_lock:
+                self._conns.append(c)
+        return c
+
+    def request_optimize(self):
+        """PRAGMA optimize на каждом соединении при его следующей операции.
+
+        optimize смотрит на историю запросов своего соединения, поэтому
+        запускать его с нового соединения бесполезно — ставим метку, а
+        выполняет его поток-владелец (_maybe_optimize): писатель — между
+        пачками, читатели — отдельным заданием в пуле (_optimize_job), чтобы
+        ожидание блокировки записи не ложилось на чей-то db.read.
+        """
+        self._optimize_gen += 1
+
+    def _maybe_optimize(self, c: sqlite3.Connection):
+        gen = self._optimize_gen
+        if getattr(self._local, "optimized", 0) < gen:
+            self._local.optimized = gen
+            try:
+                # блокировку записи берём сразу: иначе optimize, начав с чтения,
+                # получит SQLITE_BUSY_SNAPSHOT, если соседнее соединение успело записать
+                c.execute("BEGIN IMMEDIATE")
+                c.execute("PRAGMA optimize")
+                c.execute("COMMIT")
+            except sqlite3.Error as e:
+                if c.in_transaction:
+                    c.execute("ROLLBACK")
+                logging.warning("db: PRAGMA optimize failed: %r", e)
+
+    def _optimize_job(self):
+        self._optimize_queued = False
+        self._maybe_optimize(self._connection())
+
+    def _call(self, fn: Callable[..., T], args: tuple) -> T:
+        c = self._connection()
+        try:
+            result = fn(c, *args)
+            c.commit()
+        except BaseException:
+            c.rollback()
+            raise
+        # задание может достаться другому потоку пула; этот поставит новое после следующего чтения
+        if getattr(self._local, "optimized", 0) < self._optimize_gen and not self._optimize_queued:
+            self._optimize_queued = True
+            try:
+                self._readers.submit(self._optimize_job)
+            except RuntimeError:  # пул уже закрывается — optimize сделает close()
+                pass
+        return result
+
+    async def read(self, fn: Callable[..., T], *args) -> T:
+        """fn(conn, *args) в пуле читателей."""
+        loop = asyncio.get_running_loop()
+        with db_seconds.time("read"):
+            try:
+                return await loop.run_in_executor(self._readers, self._call, fn, args)
+            except Exception:
+                db_errors.inc("read")
+                raise
+
+    async def write(self, fn: Callable[..., T], *args) -> T:
+        """fn(conn, *args) в потоке-писателе; атомарно, результат — после COMMIT."""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        if self._writer is None:
+            self._start_writer()
+        with db_seconds.time("write"):
+            self._queue.put((fn, args, loop, fut))
+            try:
+                return await fut
+            except Exception:
+                db_errors.inc("write")
+                raise
+
+    def _start_writer(self):
+        with self._writer_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._writer_loop, name="db-write", daemon=True)
+                self._writer.start()
+
+    def _writer_loop(self):
+        c = self._connection(autocommit=True)
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stop = False
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.batch_max:
+                timeout = deadline - time.monotonic()
+                try:
+                    item = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stop = True
+                    break
+                batch.append(item)
+            self._commit_batch(c, batch)
+            self._maybe_optimize(c)
+            if stop:
+                return
+
+    def _commit_batch(self, c: sqlite3.Connection, batch: list):
+        outcomes = []
+        try:
+            c.execute("BEGIN IMMEDIATE")
+            for fn, args, _, _ in batch:
+                c.execute("SAVEPOINT op")
+                try:
+                    outcomes.append((True, fn(c, *args)))
+                    c.execute("RELEASE op")
+                except Exception as e:
+                    c.execute("ROLLBACK TO op")
+                    c.execute("RELEASE op")
+                    outcomes.append((False, e))
+            c.execute("COMMIT")
+        except Exception as e:
+            if c.in_transaction:
+                c.execute("ROLLBACK")
+            outcomes = [(False, e)] * len(batch)
+        for (_, _, loop, fut), (ok, value) in zip(batch, outcomes):
+            loop.call_soon_threadsafe(_resolve, fut, ok, value)
+
+    async def fetchone(self, sql: str, params: tuple = ()) -> sqlite3.Row | None:
+        return await self.read(lambda c: c.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> list[sqlite3.Row]:
+        return await self.read(lambda c: c.execute(sql, params).fetchall())
+
+    async def execute(self, sql: str, params: tuple = ()) -> int:
+        """Одиночная запись; возвращает rowcount."""
+        return await self.write(lambda c: c.execute(sql, params).rowcount)
+
+    def close(self):
+        self._readers.shutdown(wait=True)
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+        with self._conns_lock:
+            for c in self._conns:
+                # статистика по запросам именно этого соединения (sqlite_stat1 для планировщика)
+                try:
+                    c.execute("PRAGMA optimize")
+                except sqlite3.Error as e:
+                    logging.warning("db: PRAGMA optimize on close failed: %r", e)
+                c.close()
+            self._conns.clear()
 
-# Ensure owner is admin
-if OWNER_ID:
-    cur.execute("INSERT OR IGNORE INTO admins (tg_id, role) VALUES (?, 'owner')", (OWNER_ID,))
-    conn.commit()
 
 # ====================
-# HELPERS
+# REPOSITORIES
 # ====================
+# Ключи stats_counters. Гейджи (текущее значение, а не событие) в stats_daily не пишутся.
+STATS_GAUGES = {"wd_pending"}
+
+
+def bump_stats(c: sqlite3.Connection, **deltas: int):
+    """Изменить счётчики внутри текущей транзакции записи."""
+    day = datetime.utcnow().strftime("%Y-%m-%d")
+    for key, delta in deltas.items():
+        c.execute(
+            "INSERT INTO stats_counters (key, value) VALUES (?, ?) "
+            "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+            (key, delta),
+        )
+        if key not in STATS_GAUGES:
+            c.execute(
+                "INSERT INTO stats_daily (day, key, value) VALUES (?, ?, ?) "
+                "ON CONFLICT(day, key) DO UPDATE SET value = value + excluded.value",
+                (day, key, delta),
+            )
+
+
+class Page(NamedTuple):
+    rows: list[sqlite3.Row]  # по убыванию id
+    older: str | None  # курсор следующей страницы ("<id") или None
+    newer: str | None  # курсор предыдущей страницы (">id") или None
+
+
+def keyset_page(
+    c: sqlite3.Connection, columns: str, source: str, where: str, params: tuple, cursor: str, limit: int, key: str = "id"
+) -> Page:
+    """Страница по курсору: "" — самые новые, "<id" — старше id, ">id" — новее id.
+
+    Только запросы вида WHERE key < ? ORDER BY key DESC LIMIT n по индексу,
+    без OFFSET и COUNT — стоимость не зависит от размера таблицы. key должен
+    быть среди columns: курсор читается из строки по имени без префикса
+    таблицы ("w.id" → row["id"]).
+    """
+    key_alias = key.rsplit(".", 1)[-1]
+    backward = cursor.startswith(">")
+    anchor = int(cursor[1:]) if cursor[:1] in ("<", ">") else None
+
+    def fetch(op: str | None, value: int | None, order: str, n: int) -> list[sqlite3.Row]:
+        cond, args = (f"{where} AND {key} {op} ?", (*params, value)) if op else (where, params)
+        return c.execute(
+            f"SELECT {columns} FROM {source} WHERE {cond} ORDER BY {key} {order} LIMIT ?", (*args, n)
+        ).fetchall()
+
+    if backward:
+        rows = fetch(">", anchor, "ASC", limit + 1)
+        if not rows:  # всё, что было новее, удалили — показываем начало
+            return keyset_page(c, columns, source, where, params, "", limit, key)
+        newer = len(rows) > limit
+        rows = rows[:limit][::-1]
+        older = bool(fetch("<", rows[-1][key_alias], "DESC", 1))
+    else:
+        rows = fetch("<" if anchor else None, anchor, "DESC", limit + 1)
+        if anchor and not rows:  # страницу разобрали/удалили — показываем ближайшую новее
+            return keyset_page(c, columns, source, where, params, f">{anchor - 1}", limit, key)
+        older = len(rows) > limit
+        rows = rows[:limit]
+        newer = bool(anchor and fetch(">=", anchor, "ASC", 1))
+    return Page(
+        rows,
+        f"<{rows[-1][key_alias]}" if older else None,
+        f">{rows[0][key_alias]}" if newer else None,
+    )
+
+
+def enqueue_outbox(c: sqlite3.Connection, dedup_key: str, chat_id: int, text: str):
+    """Положить уведомление в outbox внутри текущей транзакции записи.
+
+    Повтор с тем же dedup_key игнорируется — одно событие даёт одно сообщение.
+    """
+    c.execute(
+        "INSERT OR IGNORE INTO outbox (dedup_key, chat_id, text) VALUES (?, ?, ?)",
+        (dedup_key, chat_id, text),
+    )
+
+
+def post_ledger(c: sqlite3.Connection, user_id: int, delta: int, reason: str, ref_id: int | None = None):
+    """Проводка + снимок users.balance внутри текущей транзакции записи.
+
+    Единственное место, где меняется баланс. Повтор события с тем же
+    (reason, ref_id) упадёт на idx_ledger_event — и откатит всю операцию.
+    """
+    c.execute(
+        "INSERT INTO ledger (user_id, delta, reason, ref_id) VALUES (?, ?, ?, ?)",
+        (user_id, delta, reason, ref_id),
+    )
+    c.execute("UPDATE users SET balance = balance + ? WHERE id=?", (delta, user_id))
+
+
+class UserRepo:
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def get(self, tg_id: int) -> sqlite3.Row | None:
+        return await self.db.fetchone("SELECT * FROM users WHERE tg_id=?", (tg_id,))
+
+    async def ensure(self, tg_id: int, username: str, first_name: str) -> sqlite3.Row:
+        """Строка users; создаётся при первом обращении."""
+        row = await self.get(tg_id)
+        if row is not None:
+            return row
+
+        def _create(c: sqlite3.Connection) -> sqlite3.Row:
+            cur = c.execute(
+                "INSERT OR IGNORE INTO users (tg_id, username, first_name) VALUES (?, ?, ?)",
+                (tg_id, username, first_name),
+            )
+            if cur.rowcount:
+                bump_stats(c, users=1)
+            return c.execute("SELECT * FROM users WHERE tg_id=?", (tg_id,)).fetchone()
+
+        return await self.db.write(_create)
+
+    async def set_banned(self, tg_id: int, banned: bool):
+        await self.db.execute("UPDATE users SET is_banned=? WHERE tg_id=?", (1 if banned else 0, tg_id))
+
+    async def add_balance(self, tg_id: int, delta: int, admin_id: int | None = None) -> bool:
+        """Ручная правка баланса админом; False — нет такого пользователя."""
+        def _add(c: sqlite3.Connection) -> bool:
+            row = c.execute("SELECT id FROM users WHERE tg_id=?", (tg_id,)).fetchone()
+            if not row:
+                return False
+            post_ledger(c, row[0], delta, "admin", admin_id)
+            return True
+
+        return await self.db.write(_add)
+
+    async def set_blocked(self, tg_id: int, blocked: bool):
+        await self.db.execute("UPDATE users SET is_blocked=? WHERE tg_id=?", (1 if blocked else 0, tg_id))
+
+    async def recipients_after(self, after_id: int, limit: int) -> list[sqlite3.Row]:
+        return await self.db.fetchall(
+            "SELECT id, tg_id FROM users WHERE id > ? AND is_blocked=0 ORDER BY id LIMIT ?",
+            (after_id, limit),
+        )
+
+
+class AdminRepo:
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def all_ids(self) -> set[int]:
+        return {r[0] for r in await self.db.fetchall("SELECT tg_id FROM admins")}
+
+    async def version(self) -> str | None:
+        row = await self.db.fetchone("SELECT value FROM settings WHERE key='admins_version'")
+        return row[0] if row else None
+
+
+class SponsorRepo:
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def active(self) -> list[sqlite3.Row]:
+        return await self.db.fetchall("SELECT * FROM sponsors WHERE active=1")
+
+    async def page(self, cursor: str, limit: int = ADMIN_PAGE_SIZE) -> Page:
+        return await self.db.read(keyset_page, "*", "sponsors", "1", (), cursor, limit)
+
+    async def upsert(self, chat_id: int, username: str | None, title: str | None):
+        await self.db.execute(
+            "INSERT OR REPLACE INTO sponsors (chat_id, username, title, active) VALUES (?, ?, ?, 1)",
+            (chat_id, username, title),
+        )
+
+    async def toggle(self, sp_id: int):
+        await self.db.execute("UPDATE sponsors SET active = CASE active WHEN 1 THEN 0 ELSE 1 END WHERE id=?", (sp_id,))
+
+    async def delete(self, sp_id: int):
+        await self.db.execute("DELETE FROM sponsors WHERE id=?", (sp_id,))
+
+
+class TaskRepo:
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def get(self, task_id: int) -> sqlite3.Row | None:
+        return await self.db.fetchone("SELECT * FROM tasks WHERE id=?", (task_id,))
+
+    async def active(self) -> list[sqlite3.Row]:
+        return await self.db.fetchall("SELECT * FROM tasks WHERE active=1 ORDER BY id DESC")
+
+    async def page(self, cursor: str, limit: int = ADMIN_PAGE_SIZE) -> Page:
+        return await self.db.read(keyset_page, "*", "tasks", "1", (), cursor, limit)
+
+    async def feed(self, user_id: int, cursor: str, limit: int = TASKS_PAGE_SIZE) -> Page:
+        """Активные задания, которые юзер (users.id) ещё не выполнил, страницами по id."""
+        where = (
+            "active=1 AND NOT EXISTS (SELECT 1 FROM user_tasks ut "
+            "WHERE ut.user_id=? AND ut.task_id=tasks.id AND ut.status IN ('done', 'left'))"
+        )
+        return await self.db.read(keyset_page, "id, title, reward", "tasks", where, (user_id,), cursor, limit)
+
+    async def catalog_version(self) -> str | None:
+        """settings.catalog_version — растёт триггерами на любую правку tasks/sponsors."""
+        row = await self.db.fetchone("SELECT value FROM settings WHERE key='catalog_version'")
+        return row[0] if row else None
+
+    async def add_subscribe(self, title: str, reward: int, chat_id: int, url: str | None):
+        await self.db.execute(
+            "INSERT INTO tasks (type, title, reward, target_chat_id, url, active) VALUES ('subscribe', ?, ?, ?, ?, 1)",
+            (title, reward, chat_id, url),
+        )
+
+    async def toggle(self, task_id: int):
+        await self.db.execute("UPDATE tasks SET active = CASE active WHEN 1 THEN 0 ELSE 1 END WHERE id=?", (task_id,))
+
+    async def is_done(self, tg_id: int, task_id: int) -> bool:
+        row = await self.db.fetchone(
+            "SELECT status FROM user_tasks WHERE user_id=(SELECT id FROM users WHERE tg_id=?) AND task_id=?",
+            (tg_id, task_id),
+        )
+        # 'left' тоже зачтено: повторная подписка награду второй раз не даёт
+        return bool(row) and row["status"] in ("done", "left")
+
+    async def complete(self, tg_id: int, task_id: int, reward: int) -> bool:
+        """Отметить задание выполненным и начислить награду. False — уже было зачтено."""
+        def _complete(c: sqlite3.Connection) -> bool:
+            row = c.execute("SELECT id FROM users WHERE tg_id=?", (tg_id,)).fetchone()
+            if not row:
+                return False
+            uid = row[0]
+            # Одна условная запись: строка меняется, только если задание ещё не было зачтено.
+            # Награда — только если она действительно изменилась.
+            changed = c.execute(
+                "INSERT INTO user_tasks (user_id, task_id, status, checked_at) VALUES (?, ?, 'done', ?) "
+                "ON CONFLICT(user_id, task_id) DO UPDATE SET status='done', checked_at=excluded.checked_at "
+                "WHERE user_tasks.status NOT IN ('done', 'left')",
+                (uid, task_id, datetime.utcnow().isoformat()),
+            ).rowcount
+            if changed != 1:
+                return False
+            c.execute("UPDATE users SET completed_tasks = completed_tasks + 1 WHERE id=?", (uid,))
+            post_ledger(c, uid, reward, "task", task_id)
+            bump_stats(c, tasks_done=1, gold_paid=reward)
+            return True
+
+        return await self.db.write(_complete)
+
+    async def verify_cursor(self) -> tuple[str, int] | None:
+        """Где остановился текущий проход перепроверки: (checked_at, id) последней строки."""
+        row = await self.db.fetchone("SELECT value FROM settings WHERE key='verify_cursor'")
+        if not row or not row[0]:
+            return None
+        checked_at, _, ut_id = row[0].rpartition("|")
+        return checked_at, int(ut_id)
+
+    async def done_before(self, cursor: tuple[str, int] | None, limit: int) -> list[sqlite3.Row]:
+        """Зачтённые подписки от свежих к старым, keyset по (checked_at, id)."""
+        where, params = "", ()
+        if cursor:
+            where, params = "AND (ut.checked_at, ut.id) < (?, ?)", cursor
+        return await self.db.fetchall(
+            "SELECT ut.id, ut.user_id, ut.task_id, ut.checked_at, u.tg_id, t.target_chat_id, t.reward "
+            "FROM user_tasks ut JOIN users u ON u.id=ut.user_id JOIN tasks t ON t.id=ut.task_id "
+            f"WHERE ut.status='done' AND ut.checked_at IS NOT NULL AND t.type='subscribe' {where} "
+            "ORDER BY ut.checked_at DESC, ut.id DESC LIMIT ?",
+            (*params, limit),
+        )
+
+    async def settle_verification(
+        self, kept: list[int], left: list[sqlite3.Row], cursor: tuple[str, int] | None, clawback: bool
+    ) -> int:
+        """Итоги пачки перепроверки вместе с курсором — одной транзакцией.
+
+        kept — id строк, где подписка на месте; left — строки из done_before,
+        где юзер отписался: статус 'left', при clawback награда списывается
+        проводкой task_clawback. cursor=None — проход закончен. Вернёт, сколько
+        отписок записано.
+        """
+        def _settle(c: sqlite3.Connection) -> int:
+            now = datetime.utcnow().isoformat()
+            c.executemany("UPDATE user_tasks SET verified_at=? WHERE id=?", [(now, i) for i in kept])
+            n = 0
+            for r in left:
+                # строку могли поменять между чтением и записью — тогда не трогаем
+                if c.execute(
+                    "UPDATE user_tasks SET status='left', verified_at=? WHERE id=? AND status='done'", (now, r["id"])
+                ).rowcount != 1:
+                    continue
+                n += 1
+                c.execute("UPDATE users SET completed_tasks = MAX(completed_tasks - 1, 0) WHERE id=?", (r["user_id"],))
+                bump_stats(c, tasks_left=1)
+                if clawback:
+                    post_ledger(c, r["user_id"], -r["reward"], "task_clawback", r["task_id"])
+                    bump_stats(c, gold_clawed_back=r["reward"])
+            if cursor:
+                c.execute(
+                    "INSERT INTO settings (key, value) VALUES ('verify_cursor', ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+                    (f"{cursor[0]}|{cursor[1]}",),
+                )
+            else:
+                c.execute("DELETE FROM settings WHERE key='verify_cursor'")
+            return n
+
+        return await self.db.write(_settle)
+
+
+def _enqueue_withdraw_status(c: sqlite3.Connection, w_id: int, row: sqlite3.Row, status: str, comment: str | None):
+    text = (
+        f"Ваша заявка #{w_id}: {status.upper()}\n"
+        f"Сумма: {row['amount']} Gold\n"
+        f"Аккаунт: {row['game_account']}\n"
+        f"Комментарий: {comment or '—'}"
+    )
+    enqueue_outbox(c, f"wd:{w_id}:{status}", row["tg_id"], text)
+
+
+class WithdrawalRepo:
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def create(self, tg_id: int, username: str | None, amount: int, account: str):
+        def _create(c: sqlite3.Connection):
+            uid = c.execute("SELECT id FROM users WHERE tg_id=?", (tg_id,)).fetchone()[0]
+            w_id = c.execute(
+                "INSERT INTO withdrawals (user_id, amount, game_account) VALUES (?, ?, ?)",
+                (uid, amount, account),
+            ).lastrowid
+            post_ledger(c, uid, -amount, "withdraw", w_id)
+            bump_stats(c, wd_created=1, wd_pending=1)
+            if OWNER_ID:
+                text = (
+                    f"🧾 Новая заявка на вывод #{w_id}\n\n"
+                    f"User: @{username or tg_id} ({tg_id})\n"
+                    f"Сумма: {amount} Gold\n"
+                    f"Аккаунт: {account}"
+                )
+                enqueue_outbox(c, f"wd:{w_id}:created", OWNER_ID, text)
+
+        await self.db.write(_create)
+
+    async def pending_page(self, cursor: str, limit: int = ADMIN_PAGE_SIZE) -> Page:
+        return await self.db.read(
+            keyset_page,
+            "w.id, u.tg_id, u.username, w.amount, w.game_account, w.status, w.created_at",
+            "withdrawals w JOIN users u ON u.id=w.user_id",
+            "w.status='pending'", (), cursor, limit, "w.id",
+        )
+
+    async def approve(self, w_id: int, admin_id: int):
+        await self.approve_many([w_id], admin_id)
+
+    async def approve_many(self, w_ids: list[int], admin_id: int) -> list[int]:
+        """Одобрить заявки одной транзакцией, вернуть id реально одобренных (ещё ожидавших)."""
+        def _approve(c: sqlite3.Connection) -> list[int]:
+            now = datetime.utcnow().isoformat()
+            done, total = [], 0
+            for w_id in w_ids:
+                row = c.execute(
+                    "UPDATE withdrawals SET status='approved', processed_by=?, processed_at=?, comment='Выплачено' "
+                    "WHERE id=? AND status='pending' RETURNING amount, game_account, "
+                    "(SELECT tg_id FROM users WHERE users.id=withdrawals.user_id) AS tg_id",
+                    (admin_id, now, w_id),
+                ).fetchone()
+                if not row:
+                    continue
+                done.append(w_id)
+                total += row["amount"]
+                _enqueue_withdraw_status(c, w_id, row, "approved", "Выплачено")
+            if done:
+                bump_stats(c, wd_pending=-len(done), wd_approved=len(done), gold_withdrawn=total)
+            return done
+
+        return await self.db.write(_approve)
+
+    async def pending_between(self, lo: int, hi: int) -> list[int]:
+        rows = await self.db.fetchall(
+            "SELECT id FROM withdrawals WHERE status='pending' AND id BETWEEN ? AND ? ORDER BY id DESC", (lo, hi)
+        )
+        return [r["id"] for r in rows]
+
+    async def reject(self, w_id: int, admin_id: int):
+        def _reject(c: sqlite3.Connection):
+            # Вернуть баланс
+            row = c.execute(
+                "SELECT w.user_id, w.amount, w.game_account, u.tg_id FROM withdrawals w JOIN users u ON u.id=w.user_id "
+                "WHERE w.id=? AND w.status='pending'",
+                (w_id,),
+            ).fetchone()
+            if not row:
+                return
+            post_ledger(c, row["user_id"], row["amount"], "withdraw_refund", w_id)
+            c.execute(
+                "UPDATE withdrawals SET status='rejected', processed_by=?, processed_at=?, comment='Отказ' WHERE id=? AND status='pending'",
+                (admin_id, datetime.utcnow().isoformat(), w_id),
+            )
+            bump_stats(c, wd_pending=-1, wd_rejected=1)
+            _enqueue_withdraw_status(c, w_id, row, "rejected", "Отказ")
+
+        await self.db.write(_reject)
+
+
+class BroadcastRepo:
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def create(self, text: str, admin_chat_id: int, progress_message_id: int) -> int:
+        def _create(c: sqlite3.Connection) -> int:
+            total = c.execute("SELECT COUNT(*) FROM users WHERE is_blocked=0").fetchone()[0]
+            return c.execute(
+                "INSERT INTO broadcasts (text, admin_chat_id, progress_message_id, total) VALUES (?, ?, ?, ?)",
+                (text, admin_chat_id, progress_message_id, total),
+            ).lastrowid
+
+        return await self.db.write(_create)
+
+    async def get(self, bc_id: int) -> sqlite3.Row | None:
+        return await self.db.fetchone("SELECT * FROM broadcasts WHERE id=?", (bc_id,))
+
+    async def running(self) -> list[sqlite3.Row]:
+        return await self.db.fetchall("SELECT id FROM broadcasts WHERE status='running' ORDER BY id")
+
+    async def save_progress(self, bc_id: int, last_user_id: int, sent: int, failed: int, blocked_ids: list[int]):
+        """Курсор, счётчики и пометка заблокировавших бота — одной транзакцией."""
+        def _save(c: sqlite3.Connection):
+            if blocked_ids:
+                c.executemany("UPDATE users SET is_blocked=1 WHERE tg_id=?", [(i,) for i in blocked_ids])
+            c.execute(
+                "UPDATE broadcasts SET last_user_id=?, sent=sent+?, failed=failed+?, blocked=blocked+? WHERE id=?",
+                (last_user_id, sent, failed, len(blocked_ids), bc_id),
+            )
+
+        await self.db.write(_save)
+
+    async def finish(self, bc_id: int):
+        await self.db.execute(
+            "UPDATE broadcasts SET status='done', finished_at=? WHERE id=?",
+            (datetime.utcnow().isoformat(), bc_id),
+        )
 
-def get_user(tg_id: int) -> sqlite3.Row | None:
-    cur.execute("SELECT * FROM users WHERE tg_id=?", (tg_id,))
-    return cur.fetchone()
 
+class OutboxRepo:
+    def __init__(self, db: Database):
+        self.db = db
 
-def ensure_user(msg: Message):
-    u = get_user(msg.from_user.id)
-    if not u:
-        cur.execute(
-            "INSERT INTO users (tg_id, username, first_name) VALUES (?, ?, ?)",
-            (msg.from_user.id, msg.from_user.username or "", msg.from_user.first_name or ""),
+    async def due(self, limit: int) -> list[sqlite3.Row]:
+        return await self.db.fetchall(
+            "SELECT id, chat_id, text, attempts FROM outbox "
+            "WHERE status='pending' AND next_attempt_at <= ? ORDER BY id LIMIT ?",
+            (time.time(), limit),
+        )
+
+    async def settle(self, sent: list[int], retry: list[tuple[int, float, str]], failed: list[tuple[int, str]]):
+        """Итоги пачки одной транзакцией: retry — (id, next_attempt_at, ошибка), failed — (id, ошибка)."""
+        def _settle(c: sqlite3.Connection):
+            now = datetime.utcnow().isoformat()
+            c.executemany("UPDATE outbox SET status='sent', sent_at=?, attempts=attempts+1 WHERE id=?", [(now, i) for i in sent])
+            c.executemany(
+                "UPDATE outbox SET attempts=attempts+1, next_attempt_at=?, last_error=? WHERE id=?",
+                [(at, err, i) for i, at, err in retry],
+            )
+            c.executemany(
+                "UPDATE outbox SET status='failed', attempts=attempts+1, last_error=? WHERE id=?",
+                [(err, i) for i, err in failed],
+            )
+
+        await self.db.write(_settle)
+
+    async def purge_sent(self, before: str, limit: int) -> int:
+        """Удалить до limit отправленных раньше before (ISO, UTC); вернёт, сколько удалено.
+
+        Вместе со строкой уходит и её dedup_key — к этому времени событие,
+        породившее уведомление, уже не повторится.
+        """
+        return await self.db.execute(
+            "DELETE FROM outbox WHERE id IN "
+            "(SELECT id FROM outbox WHERE status='sent' AND sent_at < ? LIMIT ?)",
+            (before, limit),
         )
-        conn.commit()
 
 
-def is_admin(tg_id: int) -> bool:
-    cur.execute("SELECT 1 FROM admins WHERE tg_id=?", (tg_id,))
-    return cur.fetchone() is not None
+class LedgerRepo:
+    """Сверка журнала с users.balance от контрольных точек.
+
+    Журнал только дописывается, а писатель в SQLite один, так что сумма
+    проводок до id N не меняется — её можно запомнить и дальше складывать
+    только новые строки. Сверка читает один снимок БД (BEGIN в читателе),
+    контрольные точки сдвигаются отдельной записью и только вперёд.
+    """
 
+    def __init__(self, db: Database):
+        self.db = db
+
+    @staticmethod
+    def _checkpoint(c: sqlite3.Connection, user_id: int) -> tuple[int, int]:
+        row = c.execute("SELECT last_ledger_id, total FROM ledger_checkpoints WHERE user_id=?", (user_id,)).fetchone()
+        return (row[0], row[1]) if row else (0, 0)
+
+    @classmethod
+    def _user_total(cls, c: sqlite3.Connection, user_id: int, head: int) -> int:
+        last, total = cls._checkpoint(c, user_id)
+        return total + c.execute(
+            "SELECT COALESCE(SUM(delta), 0) FROM ledger WHERE user_id=? AND id > ? AND id <= ?", (user_id, last, head)
+        ).fetchone()[0]
+
+    def _scan(self, c: sqlite3.Connection, only_user: int | None) -> dict:
+        c.execute("BEGIN")  # один снимок на всю сверку
+        head = c.execute("SELECT COALESCE(MAX(id), 0) FROM ledger").fetchone()[0]
+        g_last, g_total = self._checkpoint(c, 0)
+        if only_user is None:
+            g_total += c.execute("SELECT COALESCE(SUM(delta), 0) FROM ledger WHERE id > ? AND id <= ?", (g_last, head)).fetchone()[0]
+            users = [r[0] for r in c.execute("SELECT DISTINCT user_id FROM ledger WHERE id > ? AND id <= ?", (g_last, head))]
+        else:
+            users = [only_user]
+        checkpoints, mismatches = [], []
+        for uid in users:
+            total = self._user_total(c, uid, head)
+            row = c.execute("SELECT tg_id, balance FROM users WHERE id=?", (uid,)).fetchone()
+            if row is None or row["balance"] != total:
+                mismatches.append({"user_id": uid, "tg_id": row and row["tg_id"], "ledger": total, "balance": row and row["balance"]})
+            checkpoints.append((uid, head, total))
+        report = {"head": head, "checked_users": len(users), "entries": head - g_last if only_user is None else None, "mismatches": mismatches}
+        if only_user is None:
+            balances = c.execute("SELECT COALESCE(SUM(balance), 0) FROM users").fetchone()[0]
+            report.update(ledger_total=g_total, balance_total=balances)
+            # при расхождениях глобальная точка стоит на месте — следующий прогон проверит тех же снова
+            if not mismatches and balances == g_total:
+                checkpoints.append((0, head, g_total))
+        return report | {"_checkpoints": checkpoints}
+
+    async def reconcile(self, tg_id: int | None = None) -> dict:
+        """Сверить всех, у кого были проводки с прошлой сверки (или одного пользователя)."""
+        only_user = None
+        if tg_id is not None:
+            row = await self.db.fetchone("SELECT id FROM users WHERE tg_id=?", (tg_id,))
+            if not row:
+                raise ValueError(f"user {tg_id} not found")
+            only_user = row[0]
+        report = await self.db.read(self._scan, only_user)
+        checkpoints = report.pop("_checkpoints")
+
+        def _save(c: sqlite3.Connection):
+            c.executemany(
+                "INSERT INTO ledger_checkpoints (user_id, last_ledger_id, total, checked_at) VALUES (?, ?, ?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET last_ledger_id=excluded.last_ledger_id, total=excluded.total, "
+                "checked_at=excluded.checked_at WHERE excluded.last_ledger_id > ledger_checkpoints.last_ledger_id",
+                [(uid, last, total, datetime.utcnow().isoformat()) for uid, last, total in checkpoints],
+            )
+
+        if checkpoints:
+            await self.db.write(_save)
+        return report
+
+    async def reset_checkpoints(self):
+        """Следующая сверка пройдёт весь журнал с начала."""
+        await self.db.execute("DELETE FROM ledger_checkpoints")
+
+
+class StatsRepo:
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def summary(self) -> dict:
+        """Итоги и сегодняшние значения из stats_counters/stats_daily — без сканов."""
+        def _summary(c: sqlite3.Connection) -> dict:
+            totals = dict(c.execute("SELECT key, value FROM stats_counters").fetchall())
+            today = dict(
+                c.execute("SELECT key, value FROM stats_daily WHERE day=?", (datetime.utcnow().strftime("%Y-%m-%d"),)).fetchall()
+            )
+            return {"total": totals, "today": today}
+
+        return await self.db.read(_summary)
+
+    async def is_empty(self) -> bool:
+        return await self.db.fetchone("SELECT 1 FROM stats_counters LIMIT 1") is None
+
+    async def rebuild(self):
+        """Пересчитать счётчики по сырым таблицам (сверка / первый запуск)."""
+        def _rebuild(c: sqlite3.Connection):
+            c.execute("DELETE FROM stats_counters")
+            c.execute("DELETE FROM stats_daily")
+            # Итоги — теми же индексными запросами
+            totals = {
+                "users": "SELECT COUNT(*) FROM users",
+                # 'left' — зачтено и оплачено, потом отписка: в выполненных остаётся
+                "tasks_done": "SELECT COUNT(*) FROM user_tasks WHERE status IN ('done', 'left')",
+                "gold_paid": (
+                    "SELECT COALESCE(SUM(t.reward * (SELECT COUNT(*) FROM user_tasks ut "
+                    "WHERE ut.task_id=t.id AND ut.status IN ('done', 'left'))), 0) FROM tasks t"
+                ),
+                "tasks_left": "SELECT COUNT(*) FROM user_tasks WHERE status='left'",
+                "gold_clawed_back": "SELECT COALESCE(-SUM(delta), 0) FROM ledger WHERE reason='task_clawback'",
+                "wd_created": "SELECT COUNT(*) FROM withdrawals",
+                "wd_pending": "SELECT COUNT(*) FROM withdrawals WHERE status='pending'",
+                "wd_approved": "SELECT COUNT(*) FROM withdrawals WHERE status='approved'",
+                "wd_rejected": "SELECT COUNT(*) FROM withdrawals WHERE status='rejected'",
+                "gold_withdrawn": "SELECT COALESCE(SUM(amount), 0) FROM withdrawals WHERE status='approved'",
+            }
+            for key, sql in totals.items():
+                c.execute("INSERT INTO stats_counters (key, value) VALUES (?, ?)", (key, c.execute(sql).fetchone()[0]))
+            # Дневные корзины
+            daily = [
+                "SELECT substr(joined_at, 1, 10) d, 'users', COUNT(*) FROM users GROUP BY d",
+                "SELECT substr(ut.checked_at, 1, 10) d, 'tasks_done', COUNT(*) FROM user_tasks ut "
+                "WHERE ut.status IN ('done', 'left') GROUP BY d",
+                "SELECT substr(ut.checked_at, 1, 10) d, 'gold_paid', SUM(t.reward) FROM user_tasks ut "
+                "JOIN tasks t ON t.id=ut.task_id WHERE ut.status IN ('done', 'left') GROUP BY d",
+                "SELECT substr(verified_at, 1, 10) d, 'tasks_left', COUNT(*) FROM user_tasks WHERE status='left' GROUP BY d",
+                "SELECT substr(created_at, 1, 10) d, 'gold_clawed_back', -SUM(delta) FROM ledger "
+                "WHERE reason='task_clawback' GROUP BY d",
+                "SELECT substr(created_at, 1, 10) d, 'wd_created', COUNT(*) FROM withdrawals GROUP BY d",
+                "SELECT substr(processed_at, 1, 10) d, 'wd_approved', COUNT(*) FROM withdrawals WHERE status='approved' GROUP BY d",
+                "SELECT substr(processed_at, 1, 10) d, 'wd_rejected', COUNT(*) FROM withdrawals WHERE status='rejected' GROUP BY d",
+                "SELECT substr(processed_at, 1, 10) d, 'gold_withdrawn', SUM(amount) FROM withdrawals WHERE status='approved' GROUP BY d",
+            ]
+            for sql in daily:
+                c.executemany(
+                    "INSERT INTO stats_daily (day, key, value) VALUES (?, ?, ?)",
+                    [tuple(r) for r in c.execute(sql).fetchall() if r[0]],
+                )
+
+        await self.db.write(_rebuild)
+
+
+db = Database(DB_PATH)
+user_repo = UserRepo(db)
+admin_repo = AdminRepo(db)
+sponsor_repo = SponsorRepo(db)
+task_repo = TaskRepo(db)
+withdrawal_repo = WithdrawalRepo(db)
+outbox_repo = OutboxRepo(db)
+broadcast_repo = BroadcastRepo(db)
+stats_repo = StatsRepo(db)
+ledger_repo = LedgerRepo(db)
+
+# ====================
+# HELPERS
+# ====================
+
+class AdminCache:
+    """tg_id админов в памяти.
+
+    Триггеры на admins увеличивают settings.admins_version, так что правки
+    таблицы (в т.ч. руками через sqlite3) подхватываются: версия сверяется
+    не чаще раза в ADMIN_CACHE_CHECK_EVERY секунд.
+    """
+
+    def __init__(self, check_every: float = ADMIN_CACHE_CHECK_EVERY):
+        self.ids: set[int] = set()
+        self.version: str | None = None
+        self.check_every = check_every
+        self._checked_at = 0.0
+
+    async def reload(self):
+        self.version = await admin_repo.version()
+        self.ids = await admin_repo.all_ids()
+        self._checked_at = time.monotonic()
+
+    async def refresh_if_changed(self):
+        if time.monotonic() - self._checked_at < self.check_every:
+            return
+        self._checked_at = time.monotonic()
+        if await admin_repo.version() != self.version:
+            await self.reload()
+            logging.info("Admins reloaded: %s", len(self.ids))
+
+    def __contains__(self, tg_id: int) -> bool:
+        return tg_id in self.ids
+
+
+admin_cache = AdminCache()
+
+
+class TokenBucket:
+    """rate токенов в секунду, не больше burst про запас."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, n: float = 1) -> bool:
+        now = time.monotonic()
+        if now < self.paused_until:
+            return False
+        self._refill(now)
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
 
-async def is_member(bot: Bot, chat_id: int, user_id: int) -> bool:
+    def refund(self, n: float = 1):
+        """Вернуть токены, взятые под действие, которое не состоялось."""
+        self.tokens = min(self.capacity, self.tokens + n)
+
+    async def acquire(self, n: float = 1):
+        while not self.try_take(n):
+            now = time.monotonic()
+            wait = max(self.paused_until - now, (n - self.tokens) / self.rate)
+            await asyncio.sleep(max(wait, 0.001))
+
+    def pause(self, seconds: float):
+        """RetryAfter: никто не берёт токены, пока Telegram не разрешит."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+
+
+def _parse_rate(spec: str) -> tuple[float, float]:
+    rate, burst = spec.split("/")
+    return float(rate), float(burst)
+
+
+class KeyedLocks:
+    """asyncio.Lock на ключ; запись удаляется, как только лок никому не нужен."""
+
+    def __init__(self):
+        self._locks: dict[Any, asyncio.Lock] = {}
+        self._holders: dict[Any, int] = {}
+
+    @asynccontextmanager
+    async def hold(self, key):
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        self._holders[key] = self._holders.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._holders[key] -= 1
+            if not self._holders[key]:
+                del self._holders[key]
+                del self._locks[key]
+
+
+user_locks = KeyedLocks()
+
+MEMBER_STATUSES = {"member", "administrator", "creator"}
+
+
+def _is_subscribed(member: ChatMember) -> bool:
+    # restricted с is_member=True — в чате, только с ограничениями (не отписка)
+    return member.status in MEMBER_STATUSES or (member.status == "restricted" and member.is_member)
+
+
+class MemberCache:
+    """LRU + TTL для результатов getChatMember, ключ (chat_id, user_id)."""
+
+    def __init__(self, maxsize: int, pos_ttl: float, neg_ttl: float, recheck_after: float = 0.0):
+        self.maxsize = maxsize
+        self.pos_ttl = pos_ttl
+        self.neg_ttl = neg_ttl
+        self.recheck_after = recheck_after
+        self._data: OrderedDict[tuple[int, int], tuple[bool, float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, chat_id: int, user_id: int, trust_negative: bool = True) -> bool | None:
+        key = (chat_id, user_id)
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        value, expires_at = item
+        now = time.monotonic()
+        if expires_at < now:
+            del self._data[key]
+            self.misses += 1
+            return None
+        # отрицательный ответ положен с neg_ttl — его возраст восстанавливается по сроку
+        if not value and not trust_negative and expires_at - self.neg_ttl + self.recheck_after <= now:
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, chat_id: int, user_id: int, value: bool):
+        key = (chat_id, user_id)
+        ttl = self.pos_ttl if value else self.neg_ttl
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, chat_id: int, user_id: int):
+        if self._data.pop((chat_id, user_id), None) is not None:
+            self.invalidations += 1
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+member_cache = MemberCache(MEMBER_CACHE_SIZE, MEMBER_CACHE_POS_TTL, MEMBER_CACHE_NEG_TTL, MEMBER_RECHECK_AFTER)
+_member_check_sem = asyncio.Semaphore(MEMBER_CHECK_CONCURRENCY)
+
+
+async def is_member(bot: Bot, chat_id: int, user_id: int, trust_negative: bool = True) -> bool:
+    # trust_negative=False — для кнопок «Проверить»: юзер только что подписался,
+    # закэшированное «не подписан» старше MEMBER_RECHECK_AFTER надо перепроверить.
+    cached = member_cache.get(chat_id, user_id, trust_negative)
+    if cached is not None:
+        return cached
     try:
-        member = await bot.get_chat_member(chat_id, user_id)
-        return member.status in {"member", "administrator", "creator"}
+        async with _member_check_sem:
+            member = await bot.get_chat_member(chat_id, user_id)
+        ok = _is_subscribed(member)
     except TelegramBadRequest:
-        return False
+        ok = False
+    member_cache.put(chat_id, user_id, ok)
+    return ok
 
 
 def main_menu_kb() -> InlineKeyboardMarkup:
@@ -217,9 +1627,7 @@ def back_menu_kb() -> InlineKeyboardMarkup:
     )
 
 
-async def sponsor_check_kb(bot: Bot) -> InlineKeyboardMarkup:
-    cur.execute("SELECT * FROM sponsors WHERE active=1")
-    rows = cur.fetchall()
+def _build_sponsor_kb(rows: list[sqlite3.Row]) -> InlineKeyboardMarkup:
     kb = InlineKeyboardBuilder()
     for r in rows:
         url = f"https://t.me/{r['username']}" if r["username"] else ""
@@ -229,12 +1637,903 @@ async def sponsor_check_kb(bot: Bot) -> InlineKeyboardMarkup:
     return kb.as_markup()
 
 
-async def require_sponsor_membership(bot: Bot, user_id: int) -> bool:
-    cur.execute("SELECT chat_id FROM sponsors WHERE active=1")
-    for row in cur.fetchall():
-        if not await is_member(bot, row["chat_id"], user_id):
-            return False
-    return True
+def _cursor_of(data: str) -> str:
+    tail = data.rsplit(":", 1)[-1]
+    return tail if tail[:1] in ("<", ">") else ""
+
+
+def _page_nav(kb: InlineKeyboardBuilder, prefix: str, page: Page):
+    nav = []
+    if page.newer:
+        nav.append(InlineKeyboardButton(text="◀️", callback_data=f"{prefix}:{page.newer}"))
+    if page.older:
+        nav.append(InlineKeyboardButton(text="▶️", callback_data=f"{prefix}:{page.older}"))
+    if nav:
+        kb.row(*nav)
+
+
+def _build_tasks_kb(page: Page) -> InlineKeyboardMarkup:
+    kb = InlineKeyboardBuilder()
+    for r in page.rows:
+        kb.button(text=f"➕ {r['title']} (+{r['reward']} Gold)", callback_data=f"task:{r['id']}")
+    kb.adjust(1)
+    _page_nav(kb, "tasks", page)
+    kb.row(InlineKeyboardButton(text="⬅️ В меню", callback_data="menu"))
+    return kb.as_markup()
+
+
+def _build_task_kb(t: sqlite3.Row) -> InlineKeyboardMarkup:
+    url = t["url"] or (f"https://t.me/{t['target_chat_id']}" if isinstance(t["target_chat_id"], str) else None)
+    kb = InlineKeyboardBuilder()
+    if t["type"] == "subscribe":
+        if url:
+            kb.button(text="🔗 Открыть канал", url=url)
+        kb.button(text="✅ Проверить", callback_data=f"task_check:{t['id']}")
+    kb.button(text="⬅️ Назад", callback_data="tasks")
+    return kb.as_markup()
+
+
+class Catalog:
+    """Снимок активных заданий и спонсоров в памяти.
+
+    Таблицы меняет только админ, поэтому пользовательские хэндлеры читают
+    отсюда без БД (кроме ленты заданий — она своя у каждого юзера, см.
+    TaskRepo.feed). После каждой правки админ-хэндлер вызывает reload():
+    снимок и готовые клавиатуры пересобираются, version растёт. Правки из
+    других процессов (воркеры supervisor-режима, sqlite3 руками) ловит
+    refresh_if_changed() по settings.catalog_version, как у AdminCache.
+    """
+
+    def __init__(self, check_every: float = CATALOG_CHECK_EVERY):
+        self.version = 0
+        self.db_version: str | None = None
+        self.check_every = check_every
+        self._checked_at = 0.0
+        self.tasks: dict[int, sqlite3.Row] = {}
+        self.sponsors: list[sqlite3.Row] = []
+        self.task_kbs: dict[int, InlineKeyboardMarkup] = {}
+        self.sponsors_kb = _build_sponsor_kb([])
+        self._lock = asyncio.Lock()
+
+    async def reload(self):
+        async with self._lock:
+            db_version = await task_repo.catalog_version()
+            tasks = await task_repo.active()
+            sponsors = await sponsor_repo.active()
+            task_kbs = {t["id"]: _build_task_kb(t) for t in tasks}
+            sponsors_kb = _build_sponsor_kb(sponsors)
+            # подменяем всё разом, без await между присваиваниями
+            self.tasks = {t["id"]: t for t in tasks}
+            self.sponsors = sponsors
+            self.task_kbs, self.sponsors_kb = task_kbs, sponsors_kb
+            self.version += 1
+            self.db_version = db_version
+            self._checked_at = time.monotonic()
+        logging.info("Catalog v%s: %s tasks, %s sponsors", self.version, len(tasks), len(sponsors))
+
+    async def refresh_if_changed(self):
+        if time.monotonic() - self._checked_at < self.check_every:
+            return
+        self._checked_at = time.monotonic()
+        if await task_repo.catalog_version() != self.db_version:
+            await self.reload()
+
+
+catalog = Catalog()
+
+
+def sponsor_check_kb() -> InlineKeyboardMarkup:
+    return catalog.sponsors_kb
+
+
+async def require_sponsor_membership(bot: Bot, user_id: int, trust_negative: bool = True) -> bool:
+    # Все спонсоры проверяются параллельно (общий лимит — _member_check_sem);
+    # на первом «не подписан» остальные запросы отменяются.
+    checks = [asyncio.create_task(is_member(bot, r["chat_id"], user_id, trust_negative)) for r in catalog.sponsors]
+    try:
+        for fut in asyncio.as_completed(checks):
+            if not await fut:
+                return False
+        return True
+    finally:
+        for t in checks:
+            t.cancel()
+
+
+# ====================
+# OUTBOUND
+# ====================
+class Lane(IntEnum):
+    """Приоритет исходящего сообщения: меньше — раньше."""
+
+    INTERACTIVE = 0  # ответы на действия пользователя
+    NOTIFY = 1  # уведомления (выводы, владельцу)
+    BULK = 2  # рассылки
+
+
+outbound_lane: ContextVar[Lane] = ContextVar("outbound_lane", default=Lane.INTERACTIVE)
+
+
+@contextmanager
+def send_lane(lane: Lane):
+    token = outbound_lane.set(lane)
+    try:
+        yield
+    finally:
+        outbound_lane.reset(token)
+
+
+def _is_message_method(name: str) -> bool:
+    return name.startswith(("Send", "Edit", "Copy", "Forward"))
+
+
+def _creates_message(name: str) -> bool:
+    """Повтор такого запроса, дошедшего до Telegram, — второе сообщение у юзера."""
+    return name.startswith(("Send", "Copy", "Forward"))
+
+
+def _never_delivered(e: Exception) -> bool:
+    # соединение не установилось — запрос точно не ушёл; таймаут, обрыв и 5xx — могли и дойти
+    return isinstance(e, TelegramNetworkError) and isinstance(e.__cause__, ClientConnectorError)
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """Единая точка для всех запросов к Bot API (middleware сессии aiogram).
+
+    Отправка/редактирование сообщений проходит через per-chat и глобальный
+    token bucket; когда глобальных токенов не хватает, их раздают по очереди
+    приоритетов (Lane) — ответы пользователю обгоняют уведомления, а те —
+    рассылку. TelegramRetryAfter ставит на паузу весь глобальный поток, запрос
+    повторяется. Сетевые/5xx ошибки повторяются с backoff, но Send/Copy/Forward —
+    только если запрос заведомо не дошёл: иначе повтор продублирует сообщение.
+    """
+
+    def __init__(
+        self,
+        rate: float = OUTBOUND_RATE,
+        chat_rate: tuple[float, float] = _parse_rate(OUTBOUND_CHAT_RATE),
+        max_retries: int = OUTBOUND_MAX_RETRIES,
+        chat_idle_ttl: float = 60,
+    ):
+        self.global_bucket = TokenBucket(rate, rate)
+        self.chat_rate = chat_rate
+        self.chat_idle_ttl = chat_idle_ttl
+        self.max_retries = max_retries
+        self._chat_buckets: OrderedDict[int | str, TokenBucket] = OrderedDict()
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._pump: asyncio.Task | None = None
+        self.requests: Counter[str] = Counter()
+        self.retries: Counter[str] = Counter()
+        self.retry_after: Counter[str] = Counter()
+        self.failures: Counter[str] = Counter()
+
+    def _chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(*self.chat_rate)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        now = time.monotonic()
+        while len(self._chat_buckets) > 1:
+            oldest = next(iter(self._chat_buckets.values()))
+            if now - oldest.updated < self.chat_idle_ttl:
+                break
+            self._chat_buckets.popitem(last=False)
+        return bucket
+
+    async def _acquire_global(self, lane: Lane):
+        if not self._waiters and self.global_bucket.try_take():
+            return
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (lane, next(self._seq), fut))
+        if self._pump is None or self._pump.done():
+            self._pump = asyncio.create_task(self._run_pump())
+        await fut
+
+    async def _run_pump(self):
+        while self._waiters:
+            await self.global_bucket.acquire()
+            while self._waiters:
+                _, _, fut = heapq.heappop(self._waiters)
+                if not fut.done():
+                    fut.set_result(None)
+                    break
+            else:
+                self.global_bucket.tokens += 1  # все ждавшие ушли — токен не пропадает
+
+    @staticmethod
+    async def _timed(make_request, bot: Bot, method, name: str):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            api_errors.inc(name, type(e).__name__)
+            raise
+        finally:
+            api_seconds.observe(time.perf_counter() - started, name)
+
+    async def __call__(self, make_request, bot: Bot, method):
+        name = type(method).__name__
+        chat_id = getattr(method, "chat_id", None)
+        limited = _is_message_method(name)
+        self.requests[name] += 1
+        for attempt in range(self.max_retries + 1):
+            if limited:
+                if chat_id is not None:
+                    await self._chat_bucket(chat_id).acquire()
+                await self._acquire_global(outbound_lane.get())
+            try:
+                return await self._timed(make_request, bot, method, name)
+            except TelegramRetryAfter as e:
+                self.retry_after[name] += 1
+                if attempt == self.max_retries:
+                    self.failures[name] += 1
+                    raise
+                if limited:
+                    self.global_bucket.pause(e.retry_after)
+                else:
+                    await asyncio.sleep(e.retry_after)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt == self.max_retries or (_creates_message(name) and not _never_delivered(e)):
+                    self.failures[name] += 1
+                    raise
+                await asyncio.sleep(min(0.5 * 2 ** attempt, 10))
+            self.retries[name] += 1
+
+    def stats(self) -> dict:
+        return {
+            "requests": sum(self.requests.values()),
+            "retries": sum(self.retries.values()),
+            "retry_after": sum(self.retry_after.values()),
+            "failures": sum(self.failures.values()),
+            "queued": len(self._waiters),
+        }
+
+
+outbound = OutboundScheduler()
+
+
+# ====================
+# BROADCAST
+# ====================
+_broadcast_jobs: dict[int, asyncio.Task] = {}
+
+
+async def _broadcast_send(bot: Bot, chat_id: int, text: str) -> str:
+    """Одно сообщение рассылки → 'sent' / 'blocked' / 'failed'.
+
+    Темп, RetryAfter и повторы — на OutboundScheduler (полоса BULK).
+    """
+    try:
+        await bot.send_message(chat_id, text)
+        return "sent"
+    except TelegramForbiddenError:
+        return "blocked"
+    except TelegramBadRequest:
+        return "failed"
+    except Exception as e:
+        logging.warning("broadcast: send to %s failed: %r", chat_id, e)
+        return "failed"
+
+
+async def _broadcast_report(bot: Bot, bc: sqlite3.Row, done: bool = False):
+    if not bc["admin_chat_id"] or not bc["progress_message_id"]:
+        return
+    head = f"📢 Рассылка #{bc['id']}: " + ("готово" if done else "идёт…")
+    text = (
+        f"{head}\n\n"
+        f"Отправлено: {bc['sent']} из ~{bc['total']}\n"
+        f"Ошибок: {bc['failed']}, заблокировали бота: {bc['blocked']}"
+    )
+    try:
+        with send_lane(Lane.NOTIFY):
+            await bot.edit_message_text(text=text, chat_id=bc["admin_chat_id"], message_id=bc["progress_message_id"])
+    except TelegramBadRequest:
+        pass  # message is not modified / удалено
+
+
+async def run_broadcast(bot: Bot, bc_id: int):
+    """Фоновая рассылка: получатели пачками по курсору users.id, прогресс — в broadcasts.
+
+    Курсор сохраняется после каждой пачки, так что после рестарта рассылка
+    продолжается с места остановки (повторно может уйти максимум одна пачка).
+    """
+    outbound_lane.set(Lane.BULK)  # своя задача — свой контекст
+    bc = await broadcast_repo.get(bc_id)
+    cursor = bc["last_user_id"]
+    reported_at = time.monotonic()
+    while True:
+        batch = await user_repo.recipients_after(cursor, BROADCAST_BATCH)
+        if not batch:
+            break
+        results = await asyncio.gather(*(_broadcast_send(bot, r["tg_id"], bc["text"]) for r in batch))
+        blocked = [r["tg_id"] for r, res in zip(batch, results) if res == "blocked"]
+        cursor = batch[-1]["id"]
+        await broadcast_repo.save_progress(
+            bc_id, cursor, results.count("sent"), results.count("failed"), blocked
+        )
+        if time.monotonic() - reported_at >= BROADCAST_REPORT_EVERY:
+            reported_at = time.monotonic()
+            await _broadcast_report(bot, await broadcast_repo.get(bc_id))
+    await broadcast_repo.finish(bc_id)
+    await _broadcast_report(bot, await broadcast_repo.get(bc_id), done=True)
+
+
+def start_broadcast(bot: Bot, bc_id: int):
+    task = asyncio.create_task(run_broadcast(bot, bc_id))
+    _broadcast_jobs[bc_id] = task
+    task.add_done_callback(lambda _: _broadcast_jobs.pop(bc_id, None))
+
+
+async def stop_broadcasts():
+    jobs = list(_broadcast_jobs.values())
+    for task in jobs:
+        task.cancel()
+    await asyncio.gather(*jobs, return_exceptions=True)
+
+
+class BroadcastWatcher:
+    """Запускает рассылки из таблицы broadcasts — только в основном процессе.
+
+    Админ может создать рассылку в любом воркере supervisor-режима: хэндлер
+    лишь вставляет строку и зовёт wake(). В основном процессе наблюдатель
+    подхватывает её сразу, созданную в другом воркере — на ближайшем опросе.
+    Так у строки running не бывает двух задач, а после рестарта основного
+    процесса его рассылки продолжаются с сохранённого курсора.
+    """
+
+    def __init__(self, poll: float = BROADCAST_POLL):
+        self.poll = poll
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def wake(self):
+        self._wakeup.set()
+
+    def start(self, bot: Bot):
+        self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        await stop_broadcasts()
+
+    async def _run(self, bot: Bot):
+        while True:
+            self._wakeup.clear()
+            try:
+                for bc in await broadcast_repo.running():
+                    if bc["id"] not in _broadcast_jobs:
+                        logging.info("Starting broadcast #%s", bc["id"])
+                        start_broadcast(bot, bc["id"])
+            except Exception:
+                logging.exception("broadcasts: poll failed")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll)
+            except asyncio.TimeoutError:
+                pass
+
+
+broadcast_watcher = BroadcastWatcher()
+
+
+# ====================
+# OUTBOX
+# ====================
+class OutboxWorker:
+    """Досылает уведомления из таблицы outbox.
+
+    Строки попадают туда в одной транзакции с заявкой/решением по ней, так
+    что ни падение отправки, ни рестарт их не теряют. Доставка «хотя бы
+    один раз»: если процесс упадёт между отправкой и отметкой sent, сообщение
+    уйдёт повторно — дубли по одному событию отсекает dedup_key при вставке.
+    """
+
+    def __init__(self, batch: int = OUTBOX_BATCH, poll: float = OUTBOX_POLL, max_attempts: int = OUTBOX_MAX_ATTEMPTS):
+        self.batch = batch
+        self.poll = poll
+        self.max_attempts = max_attempts
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def wake(self):
+        """Вызывается после коммита записи в outbox, чтобы не ждать опроса."""
+        self._wakeup.set()
+
+    def start(self, bot: Bot):
+        self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self, bot: Bot):
+        outbound_lane.set(Lane.NOTIFY)
+        while True:
+            self._wakeup.clear()
+            try:
+                rows = await outbox_repo.due(self.batch)
+                if rows:
+                    await self._drain(bot, rows)
+            except Exception:
+                logging.exception("outbox: batch failed")
+                rows = []
+            if len(rows) < self.batch:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def _drain(self, bot: Bot, rows: list[sqlite3.Row]):
+        results = await asyncio.gather(
+            *(bot.send_message(r["chat_id"], r["text"]) for r in rows), return_exceptions=True
+        )
+        sent, retry, failed = [], [], []
+        for r, res in zip(rows, results):
+            if not isinstance(res, BaseException):
+                sent.append(r["id"])
+            elif isinstance(res, (TelegramForbiddenError, TelegramBadRequest)) or r["attempts"] + 1 >= self.max_attempts:
+                logging.warning("outbox: #%s to %s dropped: %r", r["id"], r["chat_id"], res)
+                failed.append((r["id"], repr(res)))
+            else:
+                retry.append((r["id"], time.time() + min(5 * 2 ** r["attempts"], 600), repr(res)))
+        await outbox_repo.settle(sent, retry, failed)
+
+
+outbox_worker = OutboxWorker()
+
+
+# ====================
+# VERIFIER
+# ====================
+class SubscriptionVerifier:
+    """Фоновая перепроверка зачтённых подписок.
+
+    Проход идёт пачками от свежих зачётов к старым (за свежими отписками
+    охотятся чаще всего), курсор сохраняется в settings вместе с итогами
+    пачки — после рестарта проход продолжается с места остановки. Закончив
+    проход, ждёт interval и начинает заново со свежих.
+
+    getChatMember идут мимо member_cache и _member_check_sem: свой token
+    bucket и своя параллельность, а пока все слоты интерактивных проверок
+    заняты, верификатор ждёт — кнопкам «Проверить» он не мешает.
+    """
+
+    def __init__(
+        self,
+        interval: float = VERIFY_INTERVAL,
+        batch: int = VERIFY_BATCH,
+        rate: tuple[float, float] = _parse_rate(VERIFY_RATE),
+        concurrency: int = VERIFY_CONCURRENCY,
+        clawback: bool = VERIFY_CLAWBACK,
+    ):
+        self.interval = interval
+        self.batch = batch
+        self.bucket = TokenBucket(*rate)
+        self.concurrency = concurrency
+        self.clawback = clawback
+        self.checked = 0
+        self.left = 0
+        self._task: asyncio.Task | None = None
+
+    def start(self, bot: Bot):
+        if self.interval > 0:
+            self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _check(self, bot: Bot, sem: asyncio.Semaphore, chat_id: int, user_id: int) -> bool | None:
+        """True/False — подписан или нет, None — проверить не удалось (строку не трогаем)."""
+        async with sem:
+            while _member_check_sem.locked():
+                await asyncio.sleep(0.1)
+            await self.bucket.acquire()
+            try:
+                member = await bot.get_chat_member(chat_id, user_id)
+            except TelegramBadRequest as e:
+                # бота убрали из канала, канал удалён и т.п. — это не отписка юзера
+                logging.warning("verifier: get_chat_member(%s, %s): %s", chat_id, user_id, e)
+                return None
+            except Exception as e:
+                logging.warning("verifier: get_chat_member(%s, %s) failed: %r", chat_id, user_id, e)
+                return None
+        ok = _is_subscribed(member)
+        member_cache.put(chat_id, user_id, ok)
+        return ok
+
+    async def run_pass(self, bot: Bot):
+        """Один проход (или его остаток после рестарта) до конца списка."""
+        sem = asyncio.Semaphore(self.concurrency)
+        cursor = await task_repo.verify_cursor()
+        while True:
+            rows = await task_repo.done_before(cursor, self.batch)
+            if not rows:
+                await task_repo.settle_verification([], [], None, self.clawback)
+                return
+            results = await asyncio.gather(
+                *(self._check(bot, sem, r["target_chat_id"], r["tg_id"]) for r in rows)
+            )
+            kept = [r["id"] for r, ok in zip(rows, results) if ok]
+            left = [r for r, ok in zip(rows, results) if ok is False]
+            cursor = (rows[-1]["checked_at"], rows[-1]["id"])
+            self.checked += len(rows)
+            self.left += await task_repo.settle_verification(kept, left, cursor, self.clawback)
+
+    async def _run(self, bot: Bot):
+        outbound_lane.set(Lane.BULK)
+        while True:
+            try:
+                started = time.monotonic()
+                await self.run_pass(bot)
+                logging.info(
+                    "verifier: pass done in %.0fs, checked %s, left %s", time.monotonic() - started, self.checked, self.left
+                )
+            except Exception:
+                logging.exception("verifier: pass failed")
+            await asyncio.sleep(self.interval)
+
+
+verifier = SubscriptionVerifier()
+
+
+# ====================
+# DB MAINTENANCE
+# ====================
+db_maint_seconds = metrics.histogram("bot_db_maintenance_seconds", "Время операций обслуживания БД", ("task",))
+db_maint_runs = metrics.counter("bot_db_maintenance_runs_total", "Выполнено операций обслуживания БД", ("task",))
+
+
+def _freelist(c: sqlite3.Connection) -> tuple[int, int]:
+    """(свободных страниц, режим auto_vacuum: 0 — нет, 1 — FULL, 2 — INCREMENTAL)."""
+    return c.execute("PRAGMA freelist_count").fetchone()[0], c.execute("PRAGMA auto_vacuum").fetchone()[0]
+
+
+def _incremental_vacuum(c: sqlite3.Connection, pages: int):
+    # модуль sqlite3 делает у PRAGMA incremental_vacuum(N) один шаг — освобождается
+    # одна страница, поэтому по странице за вызов (2000 страниц — десятки мс)
+    for _ in range(pages):
+        c.execute("PRAGMA incremental_vacuum(1)")
+
+
+class DbMaintenance:
+    """Плановое обслуживание SQLite.
+
+    - checkpoint: WAL больше wal_limit байт → wal_checkpoint(PASSIVE); если
+      перенесены все кадры и mode=TRUNCATE — ещё TRUNCATE, он обнуляет файл.
+      Идёт через отдельное соединение с busy timeout 1 с. PASSIVE никого
+      не ждёт; TRUNCATE, пока ждёт читателей, блокирует новые записи — не
+      дольше этой секунды, потом сдаётся до следующего тика (mode=PASSIVE,
+      если и это недопустимо).
+    - optimize: раз в optimize_every секунд db.request_optimize() — каждое
+      соединение пула выполнит PRAGMA optimize при следующей операции (ему
+      нужна своя история запросов, у свежего соединения её нет). При
+      остановке то же делает Database.close().
+    - outbox: отправленные уведомления старше outbox_keep_days удаляются
+      порциями по purge_batch (каждая — отдельная операция писателя), иначе
+      таблица и её индексы растут без конца.
+    - vacuum: свободных страниц больше vacuum_min_free → incremental_vacuum
+      порцией vacuum_pages через писателя (база должна быть в auto_vacuum=INCREMENTAL).
+
+    Каждое действие пишется в лог вместе со средней латентностью чтений
+    (db_seconds) до него и за следующий интервал — видно, дало ли оно эффект.
+    """
+
+    def __init__(
+        self,
+        interval: float = DB_MAINT_INTERVAL,
+        wal_limit: int = DB_WAL_CHECKPOINT_BYTES,
+        mode: str = DB_CHECKPOINT_MODE,
+        optimize_every: float = DB_OPTIMIZE_INTERVAL,
+        vacuum_pages: int = DB_VACUUM_PAGES,
+        vacuum_min_free: int = DB_VACUUM_MIN_FREE,
+        outbox_keep_days: float = OUTBOX_KEEP_DAYS,
+        purge_batch: int = 1000,
+    ):
+        self.interval = interval
+        self.wal_limit = wal_limit
+        self.mode = mode.upper()
+        self.optimize_every = optimize_every
+        self.vacuum_pages = vacuum_pages
+        self.vacuum_min_free = vacuum_min_free
+        self.outbox_keep_days = outbox_keep_days
+        self.purge_batch = purge_batch
+        self.last: dict[str, Any] = {}
+        self._optimized_at = time.monotonic()
+        self._reads = (0.0, 0)
+        self._pending: list[str] = []  # отчёты, ждущие латентности «после»
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        if self.interval > 0:
+            self._interval_read_ms()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    def wal_size(self) -> int:
+        try:
+            return os.path.getsize(db.path + "-wal")
+        except OSError:
+            return 0
+
+    def _interval_read_ms(self) -> float | None:
+        """Средняя латентность db.read с прошлого вызова, мс."""
+        s = db_seconds.series.get(("read",))
+        total, count = (s[-2], s[-1]) if s else (0.0, 0)
+        prev_total, prev_count = self._reads
+        self._reads = (total, count)
+        return (total - prev_total) / (count - prev_count) * 1000 if count > prev_count else None
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(db.path, timeout=1, isolation_level=None)
+
+    def _checkpoint(self) -> tuple[str, int, int]:
+        """→ (режим, кадров в WAL, перенесено в базу)."""
+        with closing(self._connect()) as c:
+            busy, frames, done = c.execute("PRAGMA wal_checkpoint(PASSIVE)").fetchone()
+            mode = "PASSIVE"
+            if self.mode == "TRUNCATE" and not busy and frames == done:
+                if not c.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchone()[0]:
+                    mode = "TRUNCATE"
+            return mode, frames, done
+
+    async def tick(self) -> list[str]:
+        """Одна проверка по всем политикам; вернёт описания сделанного."""
+        done = []
+        wal_before = self.wal_size()
+        if wal_before > self.wal_limit:
+            with db_maint_seconds.time("checkpoint"):
+                mode, frames, moved = await asyncio.to_thread(self._checkpoint)
+            db_maint_runs.inc("checkpoint")
+            done.append(
+                f"checkpoint {mode}: WAL {wal_before / 2**20:.1f} → {self.wal_size() / 2**20:.1f} MiB, "
+                f"{moved}/{frames} кадров"
+            )
+        if self.optimize_every > 0 and time.monotonic() - self._optimized_at >= self.optimize_every:
+            self._optimized_at = time.monotonic()
+            db.request_optimize()
+            db_maint_runs.inc("optimize")
+            done.append("optimize")
+        if self.outbox_keep_days > 0:
+            before = (datetime.utcnow() - timedelta(days=self.outbox_keep_days)).isoformat()
+            purged = 0
+            with db_maint_seconds.time("outbox_purge"):
+                while True:
+                    n = await outbox_repo.purge_sent(before, self.purge_batch)
+                    purged += n
+                    if n < self.purge_batch:
+                        break
+            if purged:
+                db_maint_runs.inc("outbox_purge")
+                done.append(f"outbox: удалено {purged} отправленных старше {self.outbox_keep_days:g} дн.")
+        if self.vacuum_pages > 0:
+            free, auto_vacuum = await db.read(_freelist)
+            if auto_vacuum == 2 and free > self.vacuum_min_free:
+                with db_maint_seconds.time("vacuum"):
+                    await db.write(_incremental_vacuum, min(free, self.vacuum_pages))
+                db_maint_runs.inc("vacuum")
+                before, (free, _) = free, await db.read(_freelist)
+                done.append(f"incremental_vacuum: свободных страниц {before} → {free}")
+            self.last["freelist_pages"] = free
+        self.last["wal_bytes"] = self.wal_size()
+        return done
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            read_ms = self._interval_read_ms()
+            avg = f"{read_ms:.2f} ms" if read_ms is not None else "—"
+            try:
+                done = await self.tick()
+            except Exception:
+                logging.exception("db maintenance failed")
+                done = []
+            for what in self._pending:
+                logging.info("DB maintenance: после «%s» чтения в среднем %s", what, avg)
+            self._pending = done
+            for what in done:
+                logging.info("DB maintenance: %s; чтения до этого в среднем %s", what, avg)
+
+
+db_maintenance = DbMaintenance()
+
+
+# ====================
+# FSM STORAGE
+# ====================
+class _FSMEntry:
+    __slots__ = ("state", "data", "touched")
+
+    def __init__(self, state: str | None = None, data: dict | None = None, touched: float = 0.0):
+        self.state = state
+        self.data = data or {}
+        self.touched = touched
+
+
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище в таблице fsm_state.
+
+    Чтения обслуживает LRU-кэш в памяти (в т.ч. «состояния нет» — это самый
+    частый ответ), записи копятся в dirty-наборе и раз в FSM_FLUSH_INTERVAL
+    уходят в БД одной транзакцией. Диалоги, не тронутые FSM_TTL секунд,
+    считаются брошенными и удаляются.
+    """
+
+    def __init__(
+        self,
+        db: Database,
+        cache_size: int = FSM_CACHE_SIZE,
+        flush_interval: float = FSM_FLUSH_INTERVAL,
+        ttl: float = FSM_TTL,
+    ):
+        self.db = db
+        self.cache_size = cache_size
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cache: OrderedDict[str, _FSMEntry] = OrderedDict()
+        self._dirty: set[str] = set()
+        self._flushing: set[str] = set()  # ушли из _dirty, но их запись ещё не закоммичена
+        self._flusher: asyncio.Task | None = None
+        self._purged_at = 0.0
+
+    async def _entry(self, key: StorageKey) -> tuple[str, _FSMEntry]:
+        k = self.key_builder.build(key)
+        now = time.time()
+        e = self._cache.get(k)
+        if e is None:
+            row = await self.db.fetchone(
+                "SELECT state, data FROM fsm_state WHERE key=? AND updated_at >= ?", (k, now - self.ttl)
+            )
+            # пока ждали БД, запись могла появиться
+            e = self._cache.get(k)
+            if e is None:
+                e = _FSMEntry(row["state"], json.loads(row["data"] or "{}"), now) if row else _FSMEntry(touched=now)
+                self._cache[k] = e
+                self._evict()
+        elif (e.state is not None or e.data) and e.touched < now - self.ttl:
+            e.state, e.data = None, {}
+            self._touch(k, e)  # и запустить flusher: иначе строка в БД переживёт TTL до чужой записи
+        self._cache.move_to_end(k)
+        return k, e
+
+    def _evict(self):
+        # грязные записи не выкидываем, пока не сброшены на диск: иначе промах
+        # кэша прочитает из БД старую строку до коммита flush и закэширует её
+        while len(self._cache) > self.cache_size:
+            k = next(iter(self._cache))
+            if k in self._dirty or k in self._flushing:
+                break
+            del self._cache[k]
+
+    def _touch(self, k: str, e: _FSMEntry):
+        e.touched = time.time()
+        self._dirty.add(k)
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k, e = await self._entry(key)
+        e.state = state.state if isinstance(state, State) else state
+        self._touch(k, e)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        _, e = await self._entry(key)
+        return e.state
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        k, e = await self._entry(key)
+        e.data = copy.deepcopy(dict(data))
+        self._touch(k, e)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        _, e = await self._entry(key)
+        return copy.deepcopy(e.data)
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        keys, self._dirty = self._dirty, set()
+        self._flushing |= keys
+        upserts, deletes = [], []
+        for k in keys:
+            e = self._cache.get(k)
+            if e is None or (e.state is None and not e.data):
+                deletes.append((k,))
+            else:
+                upserts.append((k, e.state, json.dumps(e.data, ensure_ascii=False), e.touched))
+        purge_before = None
+        if time.time() - self._purged_at > 60:
+            self._purged_at = time.time()
+            purge_before = self._purged_at - self.ttl
+
+        def _flush(c: sqlite3.Connection):
+            if upserts:
+                c.executemany(
+                    "INSERT INTO fsm_state (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET state=excluded.state, data=excluded.data, updated_at=excluded.updated_at",
+                    upserts,
+                )
+            if deletes:
+                c.executemany("DELETE FROM fsm_state WHERE key=?", deletes)
+            if purge_before is not None:
+                c.execute("DELETE FROM fsm_state WHERE updated_at < ?", (purge_before,))
+
+        try:
+            await self.db.write(_flush)
+        except Exception:
+            # не теряем изменения: попробуем в следующий раз
+            self._dirty |= keys
+            raise
+        finally:
+            self._flushing -= keys
+        self._evict()
+
+    async def _flush_loop(self):
+        while self._dirty:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logging.exception("FSM flush failed")
+
+    async def state_counts(self) -> Counter[str]:
+        """Диалоги по состояниям для /metrics: кэш поверх fsm_state, просроченные не в счёт.
+
+        Без flush() — scrape не должен сдвигать write-behind. Грязные записи
+        есть только в кэше, а чистые совпадают с БД, так что кэш главнее.
+        """
+        since = time.time() - self.ttl
+        rows = await self.db.fetchall(
+            "SELECT key, state FROM fsm_state WHERE state IS NOT NULL AND updated_at >= ?", (since,)
+        )
+        states = {r["key"]: r["state"] for r in rows}
+        for k, e in self._cache.items():
+            states[k] = e.state if e.touched >= since else None
+        return Counter(s for s in states.values() if s is not None)
+
+    async def close(self) -> None:
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+
+
+class KeyedEventIsolation(BaseEventIsolation):
+    """Апдейты одного FSM-ключа обрабатываются по одному, в порядке поступления.
+
+    Webhook и polling запускают каждый апдейт отдельной задачей; без этого
+    «сумма» и следующий за ней «реквизит» читают одно и то же состояние.
+    До FSM-мидлвари в feed_update нет await, так что лок берётся в порядке
+    создания задач. В отличие от SimpleEventIsolation, локи не копятся.
+    """
+
+    def __init__(self):
+        self._locks = KeyedLocks()
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey):
+        async with self._locks.hold(key):
+            yield
+
+    async def close(self) -> None:
+        pass
+
+
+fsm_storage = SQLiteStorage(db)
 
 
 # ====================
@@ -264,23 +2563,139 @@ class UserEditFSM(StatesGroup):
     delta = State()
 
 
+# ====================
+# MIDDLEWARES
+# ====================
+class UserMiddleware(BaseMiddleware):
+    """Один раз на апдейт: строка users (создаётся при первом контакте) и флаг is_admin."""
+
+    async def __call__(self, handler, event: Message | CallbackQuery, data: dict[str, Any]):
+        tg_user = event.from_user
+        if tg_user is None:
+            return await handler(event, data)
+        user = await user_repo.ensure(tg_user.id, tg_user.username or "", tg_user.first_name or "")
+        if user["is_blocked"]:
+            # снова пишет боту — значит, разблокировал
+            await user_repo.set_blocked(tg_user.id, False)
+        await admin_cache.refresh_if_changed()
+        await catalog.refresh_if_changed()
+        data["user"] = user
+        data["is_admin"] = tg_user.id in admin_cache
+        return await handler(event, data)
+
+
+def _parse_throttle_rules(spec: str) -> dict[str, tuple[float, float]]:
+    rules = {}
+    for item in filter(None, (x.strip() for x in spec.split(","))):
+        prefix, rate = item.rsplit("=", 1)
+        rules[prefix] = _parse_rate(rate)
+    return rules
+
+
+class ThrottleMiddleware(BaseMiddleware):
+    """Token bucket на (юзер, префикс callback_data) плюс общий на все такие колбэки.
+
+    Лишние нажатия получают пустой cb.answer() и дальше не идут — ни в БД,
+    ни в Bot API. Бакеты лежат в OrderedDict по времени последнего
+    обращения, поэтому простаивающие срезаются с головы за O(1) на штуку.
+    """
+
+    def __init__(
+        self,
+        rules: dict[str, tuple[float, float]],
+        global_rate: tuple[float, float],
+        idle_ttl: float = THROTTLE_IDLE_TTL,
+    ):
+        # длинные префиксы первыми: "task_check:" раньше, чем "task"
+        self.rules = sorted(rules.items(), key=lambda kv: len(kv[0]), reverse=True)
+        self.global_bucket = TokenBucket(*global_rate)
+        self.idle_ttl = idle_ttl
+        self._buckets: OrderedDict[tuple[int, str], TokenBucket] = OrderedDict()
+        self.throttled = 0
+
+    def _rule(self, data: str) -> tuple[str, tuple[float, float]] | None:
+        for prefix, rate in self.rules:
+            if data.startswith(prefix):
+                return prefix, rate
+        return None
+
+    def _cleanup(self, now: float):
+        while self._buckets:
+            bucket = next(iter(self._buckets.values()))
+            if now - bucket.updated < self.idle_ttl:
+                break
+            self._buckets.popitem(last=False)
+
+    def allow(self, user_id: int, data: str) -> bool:
+        rule = self._rule(data)
+        if rule is None:
+            return True
+        prefix, rate = rule
+        key = (user_id, prefix)
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(*rate)
+        else:
+            self._buckets.move_to_end(key)
+        ok = bucket.try_take()
+        if ok and not self.global_bucket.try_take():
+            bucket.refund()  # отбил общий лимит — юзер не виноват, его токен не сгорает
+            ok = False
+        self._cleanup(time.monotonic())
+        return ok
+
+    async def __call__(self, handler, event: CallbackQuery, data: dict[str, Any]):
+        if self.allow(event.from_user.id, event.data or ""):
+            return await handler(event, data)
+        self.throttled += 1
+        await event.answer()
+
+
+class AdminOnlyMiddleware(BaseMiddleware):
+    """Inner-middleware админ-роутера: срабатывает, только когда хэндлер уже подобран."""
+
+    async def __call__(self, handler, event: Message | CallbackQuery, data: dict[str, Any]):
+        if data.get("is_admin"):
+            return await handler(event, data)
+        if isinstance(event, CallbackQuery):
+            await event.answer("Нет доступа", show_alert=True)
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Inner-middleware: латентность и исключения по имени функции-хэндлера."""
+
+    async def __call__(self, handler, event, data: dict[str, Any]):
+        name = data["handler"].callback.__name__
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception as e:
+            handler_errors.inc(name, type(e).__name__)
+            raise
+        finally:
+            handler_seconds.observe(time.perf_counter() - started, name)
+
+
 # ====================
 # ROUTERS
 # ====================
 router = Router()
+throttle = ThrottleMiddleware(_parse_throttle_rules(THROTTLE_RULES), _parse_rate(THROTTLE_GLOBAL))
+router.message.outer_middleware(UserMiddleware())
+router.callback_query.outer_middleware(throttle)  # до UserMiddleware: флуд не доходит до БД
+router.callback_query.outer_middleware(UserMiddleware())
 
 
 @router.message(CommandStart())
-async def start(message: Message, bot: Bot):
-    ensure_user(message)
-    if get_user(message.from_user.id)["is_banned"]:
+async def start(message: Message, bot: Bot, user: sqlite3.Row):
+    if user["is_banned"]:
         await message.answer("⛔️ Вы заблокированы.")
         return
 
     if not await require_sponsor_membership(bot, message.from_user.id):
         await message.answer(
             "Чтобы начать, подпишитесь на спонсоров и нажмите \"Проверить подписку\".",
-            reply_markup=await sponsor_check_kb(bot),
+            reply_markup=sponsor_check_kb(),
         )
         return
 
@@ -311,109 +2726,94 @@ async def cb_help(cb: CallbackQuery, bot: Bot):
 
 
 @router.callback_query(F.data == "profile")
-async def cb_profile(cb: CallbackQuery):
-    u = get_user(cb.from_user.id)
+async def cb_profile(cb: CallbackQuery, user: sqlite3.Row):
     text = (
         f"👤 Профиль\n\n"
-        f"ID: {u['tg_id']}\n"
+        f"ID: {user['tg_id']}\n"
         f"Ник: @{cb.from_user.username if cb.from_user.username else '—'}\n"
-        f"Баланс: {u['balance']} Gold\n"
-        f"Выполнено заданий: {u['completed_tasks']}\n"
+        f"Баланс: {user['balance']} Gold\n"
+        f"Выполнено заданий: {user['completed_tasks']}\n"
     )
     await cb.message.edit_text(text, reply_markup=back_menu_kb())
     await cb.answer()
 
 
-@router.callback_query(F.data == "tasks")
-async def cb_tasks(cb: CallbackQuery, bot: Bot):
+@router.callback_query(F.data.regexp(r"^tasks(:|$)"))
+async def cb_tasks(cb: CallbackQuery, bot: Bot, user: sqlite3.Row):
     if not await require_sponsor_membership(bot, cb.from_user.id):
         await cb.message.edit_text(
             "Подпишитесь на спонсоров, чтобы открыть задания:",
-            reply_markup=await sponsor_check_kb(bot),
+            reply_markup=sponsor_check_kb(),
         )
         await cb.answer()
         return
 
-    cur.execute("SELECT * FROM tasks WHERE active=1 ORDER BY id DESC")
-    rows = cur.fetchall()
-    if not rows:
+    if not catalog.tasks:
         await cb.message.edit_text("Пока нет активных заданий.", reply_markup=back_menu_kb())
         await cb.answer()
         return
 
-    kb = InlineKeyboardBuilder()
-    for r in rows:
-        kb.button(text=f"➕ {r['title']} (+{r['reward']} Gold)", callback_data=f"task:{r['id']}")
-    kb.button(text="⬅️ В меню", callback_data="menu")
-    kb.adjust(1)
-    await cb.message.edit_text("Выбери задание:", reply_markup=kb.as_markup())
+    # выполненные не показываем: тап по ним — лишний getChatMember ради «уже зачтено»
+    page = await task_repo.feed(user["id"], _cursor_of(cb.data))
+    if not page.rows:
+        await cb.message.edit_text("Все задания выполнены — загляни позже.", reply_markup=back_menu_kb())
+        await cb.answer()
+        return
+
+    await cb.message.edit_text("Выбери задание:", reply_markup=_build_tasks_kb(page))
     await cb.answer()
 
 
 @router.callback_query(F.data.startswith("task:"))
 async def cb_task_open(cb: CallbackQuery, bot: Bot):
     task_id = int(cb.data.split(":")[1])
-    cur.execute("SELECT * FROM tasks WHERE id=?", (task_id,))
-    t = cur.fetchone()
-    if not t or not t["active"]:
+    t = catalog.tasks.get(task_id)
+    if not t:
         await cb.answer("Задание недоступно", show_alert=True)
         return
 
-    url = t["url"] or (f"https://t.me/{t['target_chat_id']}" if isinstance(t["target_chat_id"], str) else None)
-    kb = InlineKeyboardBuilder()
-    if t["type"] == "subscribe":
-        if t["username"] if False else True:
-            pass  # placeholder to keep structure simple
-        kb.button(text="🔗 Открыть канал", url=url)
-        kb.button(text="✅ Проверить", callback_data=f"task_check:{task_id}")
-    kb.button(text="⬅️ Назад", callback_data="tasks")
-
     text = (
         f"📌 {t['title']}\n\n"
         f"{t['description'] or ''}\n\n"
         f"Награда: {t['reward']} Gold"
     )
-    await cb.message.edit_text(text, reply_markup=kb.as_markup())
+    await cb.message.edit_text(text, reply_markup=catalog.task_kbs[task_id])
     await cb.answer()
 
 
 @router.callback_query(F.data.startswith("task_check:"))
 async def cb_task_check(cb: CallbackQuery, bot: Bot):
     task_id = int(cb.data.split(":")[1])
-    cur.execute("SELECT * FROM tasks WHERE id=?", (task_id,))
-    t = cur.fetchone()
+    t = catalog.tasks.get(task_id)
     if not t:
         await cb.answer("Задание не найдено", show_alert=True)
         return
 
-    ok = await is_member(bot, t["target_chat_id"], cb.from_user.id)
-    if not ok:
-        await cb.answer("Подписка не обнаружена. Убедись, что вступил.", show_alert=True)
-        return
+    # Повторные тапы «Проверить» ждут первый и после него видят «уже зачтено»
+    # или свежее «не подписан» (MEMBER_RECHECK_AFTER) без лишнего getChatMember;
+    # само начисление атомарно в task_repo.complete.
+    async with user_locks.hold(cb.from_user.id):
+        if await task_repo.is_done(cb.from_user.id, task_id):
+            await cb.answer("Это задание уже зачтено", show_alert=True)
+            return
 
-    # mark done and reward once
-    cur.execute("SELECT id, status FROM user_tasks WHERE user_id=(SELECT id FROM users WHERE tg_id=?) AND task_id=?", (cb.from_user.id, task_id))
-    ut = cur.fetchone()
-    if ut and ut["status"] == "done":
-        await cb.answer("Это задание уже зачтено", show_alert=True)
-        return
+        ok = await is_member(bot, t["target_chat_id"], cb.from_user.id, trust_negative=False)
+        if not ok:
+            await cb.answer("Подписка не обнаружена. Убедись, что вступил.", show_alert=True)
+            return
 
-    # upsert user_tasks
-    cur.execute("SELECT id FROM users WHERE tg_id=?", (cb.from_user.id,))
-    uid = cur.fetchone()[0]
-    cur.execute("INSERT OR IGNORE INTO user_tasks (user_id, task_id, status) VALUES (?, ?, 'new')", (uid, task_id))
-    cur.execute("UPDATE user_tasks SET status='done', checked_at=? WHERE user_id=? AND task_id=?", (datetime.utcnow().isoformat(), uid, task_id))
-    cur.execute("UPDATE users SET balance = balance + ?, completed_tasks = completed_tasks + 1 WHERE id=?", (t["reward"], uid))
-    conn.commit()
+        # mark done and reward once
+        if not await task_repo.complete(cb.from_user.id, task_id, t["reward"]):
+            await cb.answer("Это задание уже зачтено", show_alert=True)
+            return
 
     await cb.answer("Готово! Награда начислена.", show_alert=True)
     await cb.message.edit_text("✅ Задание выполнено и оплачено.", reply_markup=back_menu_kb())
 
 
 @router.callback_query(F.data == "withdraw")
-async def cb_withdraw(cb: CallbackQuery, state: FSMContext):
-    u = get_user(cb.from_user.id)
-    if u["balance"] < MIN_WITHDRAW:
+async def cb_withdraw(cb: CallbackQuery, state: FSMContext, user: sqlite3.Row):
+    if user["balance"] < MIN_WITHDRAW:
         await cb.answer(f"Минимум к выводу {MIN_WITHDRAW} Gold", show_alert=True)
         return
     await state.set_state(WithdrawFSM.amount)
@@ -425,14 +2825,13 @@ async def cb_withdraw(cb: CallbackQuery, state: FSMContext):
 
 
 @router.message(WithdrawFSM.amount)
-async def withdraw_amount(message: Message, state: FSMContext):
+async def withdraw_amount(message: Message, state: FSMContext, user: sqlite3.Row):
     try:
         amount = int(message.text.strip())
     except Exception:
         await message.answer("Введи число, например 150")
         return
-    u = get_user(message.from_user.id)
-    if amount < MIN_WITHDRAW or amount > u["balance"]:
+    if amount < MIN_WITHDRAW or amount > user["balance"]:
         await message.answer("Неверная сумма. Проверь баланс/минималку.")
         return
     await state.update_data(amount=amount)
@@ -441,57 +2840,54 @@ async def withdraw_amount(message: Message, state: FSMContext):
 
 
 @router.message(WithdrawFSM.account)
-async def withdraw_account(message: Message, state: FSMContext, bot: Bot):
+async def withdraw_account(message: Message, state: FSMContext):
     data = await state.get_data()
     amount = data["amount"]
     account = message.text.strip()
 
-    # create request
-    cur.execute("SELECT id FROM users WHERE tg_id=?", (message.from_user.id,))
-    uid = cur.fetchone()[0]
-    cur.execute(
-        "INSERT INTO withdrawals (user_id, amount, game_account) VALUES (?, ?, ?)",
-        (uid, amount, account),
-    )
-    cur.execute("UPDATE users SET balance = balance - ? WHERE id=?", (amount, uid))
-    conn.commit()
+    # заявка и уведомление владельцу — одной транзакцией, шлёт outbox_worker
+    await withdrawal_repo.create(message.from_user.id, message.from_user.username, amount, account)
+    outbox_worker.wake()
 
     await state.clear()
     await message.answer("✅ Заявка на вывод создана. Ожидайте подтверждения.")
 
-    # notify owner
-    try:
-        text = (
-            "🧾 Новая заявка на вывод\n\n"
-            f"User: @{message.from_user.username or message.from_user.id} ({message.from_user.id})\n"
-            f"Сумма: {amount} Gold\n"
-            f"Аккаунт: {account}"
-        )
-        if OWNER_ID:
-            await bot.send_message(OWNER_ID, text)
-    except Exception:
-        pass
-
 
 # ====================
 # SPONSOR CHECK
 # ====================
 @router.callback_query(F.data == "check_sponsors")
 async def cb_check_sponsors(cb: CallbackQuery, bot: Bot):
-    ok = await require_sponsor_membership(bot, cb.from_user.id)
+    ok = await require_sponsor_membership(bot, cb.from_user.id, trust_negative=False)
     if ok:
         await cb.message.edit_text("Спасибо за подписку! Меню:", reply_markup=main_menu_kb())
     else:
         await cb.answer("Ещё не все подписки найдены.", show_alert=True)
 
 
+@router.chat_member()
+async def on_chat_member(event: ChatMemberUpdated):
+    # Приходит только там, где бот админ: держим кэш подписок в актуальном виде
+    member_cache.put(event.chat.id, event.new_chat_member.user.id, _is_subscribed(event.new_chat_member))
+
+
 # ====================
 # ADMIN
 # ====================
-@router.message(Command("admin"))
+# Все админ-хэндлеры — в отдельном роутере, доступ проверяет AdminOnlyMiddleware
+admin_router = Router(name="admin")
+admin_router.message.middleware(AdminOnlyMiddleware())
+admin_router.callback_query.middleware(AdminOnlyMiddleware())
+router.include_router(admin_router)
+
+# inner-middleware корневого роутера оборачивают и хэндлеры вложенных (снаружи AdminOnly)
+_handler_metrics = HandlerMetricsMiddleware()
+for _observer in (router.message, router.callback_query, router.chat_member):
+    _observer.middleware(_handler_metrics)
+
+
+@admin_router.message(Command("admin"))
 async def admin_panel(message: Message):
-    if not is_admin(message.from_user.id):
-        return
     kb = InlineKeyboardBuilder()
     for text, data in [
         ("📊 Статистика", "a_stats"),
@@ -506,91 +2902,78 @@ async def admin_panel(message: Message):
     await message.answer("Админ‑панель:", reply_markup=kb.as_markup())
 
 
-@router.callback_query(F.data == "a_stats")
+@admin_router.callback_query(F.data == "a_stats")
 async def a_stats(cb: CallbackQuery):
-    if not is_admin(cb.from_user.id):
-        return
-    cur.execute("SELECT COUNT(*) c FROM users")
-    users_cnt = cur.fetchone()["c"]
-    cur.execute("SELECT COUNT(*) c FROM users WHERE strftime('%Y-%m-%d', joined_at)=strftime('%Y-%m-%d','now')")
-    users_today = cur.fetchone()["c"]
-    cur.execute("SELECT COUNT(*) c FROM withdrawals WHERE status='pending'")
-    wd_pending = cur.fetchone()["c"]
-    cur.execute("SELECT COALESCE(SUM(reward),0) s FROM tasks t JOIN user_tasks ut ON ut.task_id=t.id WHERE ut.status='done'")
-    paid_total = cur.fetchone()["s"]
+    st = await stats_repo.summary()
+    total, today = st["total"], st["today"]
+    mc = member_cache.stats()
+    ob = outbound.stats()
     text = (
         "📊 Статистика\n\n"
-        f"Пользователей: {users_cnt} (+{users_today} сегодня)\n"
-        f"Выплаты в Gold (начислено): {paid_total}\n"
-        f"Заявок на вывод (ожидают): {wd_pending}"
+        f"Пользователей: {total.get('users', 0)} (+{today.get('users', 0)} сегодня)\n"
+        f"Выполнено заданий: {total.get('tasks_done', 0)} (+{today.get('tasks_done', 0)} сегодня)\n"
+        f"Выплаты в Gold (начислено): {total.get('gold_paid', 0)} (+{today.get('gold_paid', 0)} сегодня)\n"
+        f"Отписались после зачёта: {total.get('tasks_left', 0)} (+{today.get('tasks_left', 0)} сегодня), "
+        f"списано Gold: {total.get('gold_clawed_back', 0)}\n"
+        f"Выведено Gold: {total.get('gold_withdrawn', 0)}\n"
+        f"Заявок на вывод (ожидают): {total.get('wd_pending', 0)}\n\n"
+        f"Кэш подписок: {mc['hits']} hit / {mc['misses']} miss ({mc['hit_rate']:.0%}), записей {mc['size']}\n"
+        f"Bot API: {ob['requests']} запросов, повторов {ob['retries']} (429: {ob['retry_after']}), "
+        f"ошибок {ob['failures']}, в очереди {ob['queued']}"
     )
     await cb.message.edit_text(text)
     await cb.answer()
 
 
 # Broadcast
-@router.callback_query(F.data == "a_bcast")
+@admin_router.callback_query(F.data == "a_bcast")
 async def a_bcast(cb: CallbackQuery, state: FSMContext):
-    if not is_admin(cb.from_user.id):
-        return
     await state.set_state(BroadcastFSM.text)
     await cb.message.edit_text("Введи текст рассылки (без форматирования):")
     await cb.answer()
 
 
-@router.message(BroadcastFSM.text)
-async def a_bcast_go(message: Message, bot: Bot, state: FSMContext):
-    if not is_admin(message.from_user.id):
-        return
+@admin_router.message(BroadcastFSM.text)
+async def a_bcast_go(message: Message, state: FSMContext):
     await state.clear()
-    cur.execute("SELECT tg_id FROM users")
-    ids = [row[0] for row in cur.fetchall()]
-    sent, fail = 0, 0
-    for uid in ids:
-        try:
-            await bot.send_message(uid, message.text)
-            sent += 1
-        except Exception:
-            fail += 1
-        await asyncio.sleep(0.03)
-    await message.answer(f"Готово. Отправлено: {sent}, ошибок: {fail}")
+    progress = await message.answer("📢 Рассылка запускается…")
+    await broadcast_repo.create(message.text, progress.chat.id, progress.message_id)
+    # запустит основной процесс (BroadcastWatcher), даже если апдейт пришёл в другой воркер
+    broadcast_watcher.wake()
 
 
+# Списки листаются по курсору: он едет последним сегментом callback_data
+# ("a_sponsors:<15", "a_sp_t:7:<15"), чтобы после действия вернуться на ту же страницу.
 # Sponsors
-@router.callback_query(F.data == "a_sponsors")
+@admin_router.callback_query(F.data.regexp(r"^a_sponsors(:|$)"))
 async def a_sponsors(cb: CallbackQuery):
-    if not is_admin(cb.from_user.id):
-        return
-    cur.execute("SELECT * FROM sponsors ORDER BY id DESC")
-    rows = cur.fetchall()
+    cursor = _cursor_of(cb.data)
+    page = await sponsor_repo.page(cursor)
     lines = ["📌 Спонсоры (активные отмечены ✅):\n"]
-    for r in rows:
+    for r in page.rows:
         lines.append(f"{r['id']}. {r['title'] or r['username'] or r['chat_id']} {'✅' if r['active'] else '❌'}")
     text = "\n".join(lines) or "Пусто"
 
     kb = InlineKeyboardBuilder()
     kb.button(text="➕ Добавить", callback_data="a_sp_add")
-    kb.button(text="♻️ Переключить", callback_data="a_sp_toggle")
-    kb.button(text="🗑 Удалить", callback_data="a_sp_del")
-    kb.button(text="⬅️ Назад", callback_data="admin")
-    kb.adjust(2, 2)
+    kb.button(text="♻️ Переключить", callback_data=f"a_sp_toggle:{cursor}")
+    kb.button(text="🗑 Удалить", callback_data=f"a_sp_del:{cursor}")
+    kb.adjust(2, 1)
+    _page_nav(kb, "a_sponsors", page)
+    kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="admin"))
     await cb.message.edit_text(text, reply_markup=kb.as_markup())
     await cb.answer()
 
 
-@router.callback_query(F.data == "a_sp_add")
+@admin_router.callback_query(F.data == "a_sp_add")
 async def a_sp_add(cb: CallbackQuery, state: FSMContext):
-    if not is_admin(cb.from_user.id):
-        return
     await state.set_state(AddSponsorFSM.username_or_id)
     await cb.message.edit_text("Введи @username или numeric ID канала/чата (бот должен иметь доступ):")
     await cb.answer()
 
 
-@router.message(AddSponsorFSM.username_or_id)
+@admin_router.message(AddSponsorFSM.username_or_id)
 async def a_sp_add_go(message: Message, state: FSMContext, bot: Bot):
-    if not is_admin(message.from_user.id):
-        return
     raw = message.text.strip()
     chat_id = raw
     if raw.startswith("@"):
@@ -606,107 +2989,98 @@ async def a_sp_add_go(message: Message, state: FSMContext, bot: Bot):
         username = chat.username or None
         title = chat.title or None
         real_id = chat.id
-        cur.execute(
-            "INSERT OR REPLACE INTO sponsors (chat_id, username, title, active) VALUES (?, ?, ?, 1)",
-            (real_id, username, title),
-        )
-        conn.commit()
+        await sponsor_repo.upsert(real_id, username, title)
+        await catalog.reload()
         await message.answer(f"Добавлен спонсор: {title or username or real_id}")
     except Exception as e:
         await message.answer(f"Ошибка: {e}")
     await state.clear()
 
 
-@router.callback_query(F.data == "a_sp_toggle")
+@admin_router.callback_query(F.data.regexp(r"^a_sp_toggle(:|$)"))
 async def a_sp_toggle(cb: CallbackQuery):
-    if not is_admin(cb.from_user.id):
-        return
-    cur.execute("SELECT id, title, username, active FROM sponsors ORDER BY id DESC")
-    rows = cur.fetchall()
+    cursor = _cursor_of(cb.data)
+    page = await sponsor_repo.page(cursor)
     kb = InlineKeyboardBuilder()
-    for r in rows:
-        kb.button(text=f"{r['id']}: {r['title'] or r['username']} ({'✅' if r['active'] else '❌'})", callback_data=f"a_sp_t:{r['id']}")
-    kb.button(text="⬅️ Назад", callback_data="a_sponsors")
+    for r in page.rows:
+        kb.button(
+            text=f"{r['id']}: {r['title'] or r['username']} ({'✅' if r['active'] else '❌'})",
+            callback_data=f"a_sp_t:{r['id']}:{cursor}",
+        )
     kb.adjust(1)
+    _page_nav(kb, "a_sp_toggle", page)
+    kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"a_sponsors:{cursor}"))
     await cb.message.edit_text("Выбери спонсора для переключения:", reply_markup=kb.as_markup())
     await cb.answer()
 
 
-@router.callback_query(F.data.startswith("a_sp_t:"))
+@admin_router.callback_query(F.data.startswith("a_sp_t:"))
 async def a_sp_tog_one(cb: CallbackQuery):
-    if not is_admin(cb.from_user.id):
-        return
     sp_id = int(cb.data.split(":")[1])
-    cur.execute("UPDATE sponsors SET active = CASE active WHEN 1 THEN 0 ELSE 1 END WHERE id=?", (sp_id,))
-    conn.commit()
+    await sponsor_repo.toggle(sp_id)
+    await catalog.reload()
     await cb.answer("Готово")
     await a_sponsors(cb)
 
 
-@router.callback_query(F.data == "a_sp_del")
+@admin_router.callback_query(F.data.regexp(r"^a_sp_del(:|$)"))
 async def a_sp_del(cb: CallbackQuery):
-    if not is_admin(cb.from_user.id):
-        return
-    cur.execute("SELECT id, title, username FROM sponsors ORDER BY id DESC")
-    rows = cur.fetchall()
+    cursor = _cursor_of(cb.data)
+    page = await sponsor_repo.page(cursor)
     kb = InlineKeyboardBuilder()
-    for r in rows:
-        kb.button(text=f"🗑 {r['id']}: {r['title'] or r['username']}", callback_data=f"a_sp_d:{r['id']}")
-    kb.button(text="⬅️ Назад", callback_data="a_sponsors")
+    for r in page.rows:
+        kb.button(text=f"🗑 {r['id']}: {r['title'] or r['username']}", callback_data=f"a_sp_d:{r['id']}:{cursor}")
     kb.adjust(1)
+    _page_nav(kb, "a_sp_del", page)
+    kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"a_sponsors:{cursor}"))
     await cb.message.edit_text("Выбери, кого удалить:", reply_markup=kb.as_markup())
     await cb.answer()
 
 
-@router.callback_query(F.data.startswith("a_sp_d:"))
+@admin_router.callback_query(F.data.startswith("a_sp_d:"))
 async def a_sp_del_one(cb: CallbackQuery):
-    if not is_admin(cb.from_user.id):
-        return
     sp_id = int(cb.data.split(":")[1])
-    cur.execute("DELETE FROM sponsors WHERE id=?", (sp_id,))
-    conn.commit()
+    await sponsor_repo.delete(sp_id)
+    await catalog.reload()
     await cb.answer("Удалено")
     await a_sponsors(cb)
 
 
 # Tasks
-@router.callback_query(F.data == "a_tasks")
+@admin_router.callback_query(F.data.regexp(r"^a_tasks(:|$)"))
 async def a_tasks(cb: CallbackQuery):
-    if not is_admin(cb.from_user.id):
-        return
-    cur.execute("SELECT * FROM tasks ORDER BY id DESC")
-    rows = cur.fetchall()
+    cursor = _cursor_of(cb.data)
+    page = await task_repo.page(cursor)
     lines = ["🧩 Задания:\n"]
-    for r in rows:
+    for r in page.rows:
         lines.append(f"{r['id']}. {r['title']} +{r['reward']} Gold ({'✅' if r['active'] else '❌'})")
     text = "\n".join(lines) or "Пусто"
 
     kb = InlineKeyboardBuilder()
     kb.button(text="➕ Добавить", callback_data="a_t_add")
-    kb.button(text="♻️ Переключить", callback_data="a_t_toggle")
-    kb.button(text="⬅️ Назад", callback_data="admin")
-    kb.adjust(2, 1)
+    kb.button(text="♻️ Переключить", callback_data=f"a_t_toggle:{cursor}")
+    kb.adjust(2)
+    _page_nav(kb, "a_tasks", page)
+    kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="admin"))
     await cb.message.edit_text(text, reply_markup=kb.as_markup())
     await cb.answer()
 
 
-@router.callback_query(F.data == "a_t_add")
+@admin_router.callback_query(F.data == "a_t_add")
 async def a_t_add(cb: CallbackQuery, state: FSMContext):
-    if not is_admin(cb.from_user.id):
-        return
     await state.set_state(AddTaskFSM.title)
     await cb.message.edit_text("Название задания (подписка):")
     await cb.answer()
 
 
-@router.message(AddTaskFSM.title)
+@admin_router.message(AddTaskFSM.title)
 async def a_t_add_title(message: Message, state: FSMContext):
     await state.update_data(title=message.text.strip())
     await state.set_state(AddTaskFSM.reward)
     await message.answer("Награда в Gold (число):")
 
 
-@router.message(AddTaskFSM.reward)
+@admin_router.message(AddTaskFSM.reward)
 async def a_t_add_reward(message: Message, state: FSMContext):
     try:
         reward = int(message.text.strip())
@@ -718,7 +3092,7 @@ async def a_t_add_reward(message: Message, state: FSMContext):
     await message.answer("Канал: @username или numeric ID (бот должен иметь доступ):")
 
 
-@router.message(AddTaskFSM.channel)
+@admin_router.message(AddTaskFSM.channel)
 async def a_t_add_channel(message: Message, state: FSMContext, bot: Bot):
     data = await state.get_data()
     title = data["title"]
@@ -737,131 +3111,119 @@ async def a_t_add_channel(message: Message, state: FSMContext, bot: Bot):
         chat = await bot.get_chat(chat_id)
         real_id = chat.id
         url = f"https://t.me/{chat.username}" if chat.username else None
-        cur.execute(
-            "INSERT INTO tasks (type, title, reward, target_chat_id, url, active) VALUES ('subscribe', ?, ?, ?, ?, 1)",
-            (title, reward, real_id, url),
-        )
-        conn.commit()
+        await task_repo.add_subscribe(title, reward, real_id, url)
+        await catalog.reload()
         await message.answer("Задание создано ✅")
     except Exception as e:
         await message.answer(f"Ошибка: {e}")
     await state.clear()
 
 
-@router.callback_query(F.data == "a_t_toggle")
+@admin_router.callback_query(F.data.regexp(r"^a_t_toggle(:|$)"))
 async def a_t_toggle(cb: CallbackQuery):
-    if not is_admin(cb.from_user.id):
-        return
-    cur.execute("SELECT id, title, active FROM tasks ORDER BY id DESC")
-    rows = cur.fetchall()
+    cursor = _cursor_of(cb.data)
+    page = await task_repo.page(cursor)
     kb = InlineKeyboardBuilder()
-    for r in rows:
-        kb.button(text=f"{r['id']}: {r['title']} ({'✅' if r['active'] else '❌'})", callback_data=f"a_t_t:{r['id']}")
-    kb.button(text="⬅️ Назад", callback_data="a_tasks")
+    for r in page.rows:
+        kb.button(text=f"{r['id']}: {r['title']} ({'✅' if r['active'] else '❌'})", callback_data=f"a_t_t:{r['id']}:{cursor}")
     kb.adjust(1)
+    _page_nav(kb, "a_t_toggle", page)
+    kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data=f"a_tasks:{cursor}"))
     await cb.message.edit_text("Выбери задание для переключения:", reply_markup=kb.as_markup())
     await cb.answer()
 
 
-@router.callback_query(F.data.startswith("a_t_t:"))
+@admin_router.callback_query(F.data.startswith("a_t_t:"))
 async def a_t_toggle_one(cb: CallbackQuery):
-    if not is_admin(cb.from_user.id):
-        return
     t_id = int(cb.data.split(":")[1])
-    cur.execute("UPDATE tasks SET active = CASE active WHEN 1 THEN 0 ELSE 1 END WHERE id=?", (t_id,))
-    conn.commit()
+    await task_repo.toggle(t_id)
+    await catalog.reload()
     await cb.answer("Готово")
     await a_tasks(cb)
 
 
 # Withdrawals
-@router.callback_query(F.data == "a_withdraws")
-async def a_withdraws(cb: CallbackQuery):
-    if not is_admin(cb.from_user.id):
-        return
-    cur.execute(
-        "SELECT w.id, u.tg_id, u.username, w.amount, w.game_account, w.status, w.created_at "
-        "FROM withdrawals w JOIN users u ON u.id=w.user_id WHERE w.status='pending' ORDER BY w.id"
-    )
-    rows = cur.fetchall()
-    if not rows:
+@admin_router.callback_query(F.data.regexp(r"^a_withdraws(:|$)"))
+async def a_withdraws(cb: CallbackQuery, state: FSMContext):
+    cursor = _cursor_of(cb.data)
+    page = await withdrawal_repo.pending_page(cursor)
+    if not page.rows:
         await cb.message.edit_text("Нет ожидающих заявок.")
         await cb.answer()
         return
+    selected = set((await state.get_data()).get("wd_selected", ()))
     kb = InlineKeyboardBuilder()
     text_lines = ["Ожидают:\n"]
-    for r in rows:
+    for r in page.rows:
         text_lines.append(
             f"#{r['id']} — @{r['username'] or r['tg_id']} — {r['amount']} Gold → {r['game_account']}"
         )
-        kb.button(text=f"✅ {r['id']}", callback_data=f"a_w_ok:{r['id']}")
-        kb.button(text=f"❌ {r['id']}", callback_data=f"a_w_no:{r['id']}")
-    kb.button(text="⬅️ Назад", callback_data="admin")
-    kb.adjust(2, 1)
+        kb.button(text=f"{'☑️' if r['id'] in selected else '⬜'} {r['id']}", callback_data=f"a_w_sel:{r['id']}:{cursor}")
+        kb.button(text=f"✅ {r['id']}", callback_data=f"a_w_ok:{r['id']}:{cursor}")
+        kb.button(text=f"❌ {r['id']}", callback_data=f"a_w_no:{r['id']}:{cursor}")
+    kb.adjust(3)
+    # «все на странице» — диапазоном id: новые заявки получают id больше, в него не попадут
+    hi, lo = page.rows[0]["id"], page.rows[-1]["id"]
+    bulk = [InlineKeyboardButton(text=f"✅ Все на странице ({len(page.rows)})", callback_data=f"a_w_oka:{hi}:{lo}:{cursor}")]
+    if selected:
+        bulk.append(InlineKeyboardButton(text=f"✅ Выбранные ({len(selected)})", callback_data=f"a_w_oks:{cursor}"))
+    kb.row(*bulk)
+    _page_nav(kb, "a_withdraws", page)
+    kb.row(InlineKeyboardButton(text="⬅️ Назад", callback_data="admin"))
     await cb.message.edit_text("\n".join(text_lines), reply_markup=kb.as_markup())
     await cb.answer()
 
 
-async def _withdraw_notify(bot: Bot, w_id: int, status: str, comment: str | None):
-    cur.execute(
-        "SELECT w.id, u.tg_id, w.amount, w.game_account FROM withdrawals w JOIN users u ON u.id=w.user_id WHERE w.id=?",
-        (w_id,)
-    )
-    r = cur.fetchone()
-    if not r:
-        return
-    text = (
-        f"Ваша заявка #{w_id}: {status.upper()}\n"
-        f"Сумма: {r['amount']} Gold\n"
-        f"Аккаунт: {r['game_account']}\n"
-        f"Комментарий: {comment or '—'}"
-    )
-    try:
-        await bot.send_message(r["tg_id"], text)
-    except Exception:
-        pass
+@admin_router.callback_query(F.data.startswith("a_w_sel:"))
+async def a_w_select(cb: CallbackQuery, state: FSMContext):
+    w_id = int(cb.data.split(":")[1])
+    selected = set((await state.get_data()).get("wd_selected", ()))
+    selected ^= {w_id}
+    await state.update_data(wd_selected=sorted(selected))
+    await a_withdraws(cb, state)
 
 
-@router.callback_query(F.data.startswith("a_w_ok:"))
-async def a_w_ok(cb: CallbackQuery, bot: Bot):
-    if not is_admin(cb.from_user.id):
-        return
+async def _approve_bulk(cb: CallbackQuery, state: FSMContext, w_ids: list[int]):
+    """Одна транзакция на все заявки, уведомления — пачкой через outbox, одно редактирование сообщения."""
+    done = await withdrawal_repo.approve_many(w_ids, cb.from_user.id) if w_ids else []
+    outbox_worker.wake()
+    await state.update_data(wd_selected=[])
+    await cb.answer(f"Одобрено: {len(done)}")
+    await a_withdraws(cb, state)
+
+
+@admin_router.callback_query(F.data.startswith("a_w_oka:"))
+async def a_w_ok_all(cb: CallbackQuery, state: FSMContext):
+    _, hi, lo = cb.data.split(":")[:3]
+    await _approve_bulk(cb, state, await withdrawal_repo.pending_between(int(lo), int(hi)))
+
+
+@admin_router.callback_query(F.data.startswith("a_w_oks:"))
+async def a_w_ok_selected(cb: CallbackQuery, state: FSMContext):
+    await _approve_bulk(cb, state, list((await state.get_data()).get("wd_selected", ())))
+
+
+@admin_router.callback_query(F.data.startswith("a_w_ok:"))
+async def a_w_ok(cb: CallbackQuery, state: FSMContext):
     w_id = int(cb.data.split(":")[1])
-    cur.execute(
-        "UPDATE withdrawals SET status='approved', processed_by=?, processed_at=?, comment='Выплачено' WHERE id=? AND status='pending'",
-        (cb.from_user.id, datetime.utcnow().isoformat(), w_id),
-    )
-    conn.commit()
-    await _withdraw_notify(bot, w_id, "approved", "Выплачено")
+    await withdrawal_repo.approve(w_id, cb.from_user.id)
+    outbox_worker.wake()
     await cb.answer("Одобрено")
-    await a_withdraws(cb)
+    await a_withdraws(cb, state)
 
 
-@router.callback_query(F.data.startswith("a_w_no:"))
-async def a_w_no(cb: CallbackQuery, bot: Bot):
-    if not is_admin(cb.from_user.id):
-        return
+@admin_router.callback_query(F.data.startswith("a_w_no:"))
+async def a_w_no(cb: CallbackQuery, state: FSMContext):
     w_id = int(cb.data.split(":")[1])
-    # Вернуть баланс
-    cur.execute("SELECT user_id, amount FROM withdrawals WHERE id=? AND status='pending'", (w_id,))
-    row = cur.fetchone()
-    if row:
-        cur.execute("UPDATE users SET balance = balance + ? WHERE id=?", (row["amount"], row["user_id"]))
-    cur.execute(
-        "UPDATE withdrawals SET status='rejected', processed_by=?, processed_at=?, comment='Отказ' WHERE id=? AND status='pending'",
-        (cb.from_user.id, datetime.utcnow().isoformat(), w_id),
-    )
-    conn.commit()
-    await _withdraw_notify(bot, w_id, "rejected", "Отказ")
+    await withdrawal_repo.reject(w_id, cb.from_user.id)
+    outbox_worker.wake()
     await cb.answer("Отклонено")
-    await a_withdraws(cb)
+    await a_withdraws(cb, state)
 
 
 # Users
-@router.callback_query(F.data == "a_users")
+@admin_router.callback_query(F.data == "a_users")
 async def a_users(cb: CallbackQuery):
-    if not is_admin(cb.from_user.id):
-        return
     kb = InlineKeyboardBuilder()
     kb.button(text="🔨 Бан", callback_data="a_u_ban")
     kb.button(text="🧯 Разбан", callback_data="a_u_unban")
@@ -872,10 +3234,8 @@ async def a_users(cb: CallbackQuery):
     await cb.answer()
 
 
-@router.callback_query(F.data.in_({"a_u_ban", "a_u_unban", "a_u_balance"}))
+@admin_router.callback_query(F.data.in_({"a_u_ban", "a_u_unban", "a_u_balance"}))
 async def a_users_choose(cb: CallbackQuery, state: FSMContext):
-    if not is_admin(cb.from_user.id):
-        return
     action = cb.data
     await state.set_state(UserEditFSM.target)
     await state.update_data(action=action)
@@ -883,7 +3243,7 @@ async def a_users_choose(cb: CallbackQuery, state: FSMContext):
     await cb.answer()
 
 
-@router.message(UserEditFSM.target)
+@admin_router.message(UserEditFSM.target)
 async def a_users_target(message: Message, state: FSMContext):
     data = await state.get_data()
     action = data["action"]
@@ -898,13 +3258,12 @@ async def a_users_target(message: Message, state: FSMContext):
         await message.answer("На сколько изменить баланс (можно -100 или +100):")
     else:
         # ban/unban
-        cur.execute("UPDATE users SET is_banned=? WHERE tg_id=?", (1 if action == "a_u_ban" else 0, uid))
-        conn.commit()
+        await user_repo.set_banned(uid, action == "a_u_ban")
         await state.clear()
         await message.answer("Готово.")
 
 
-@router.message(UserEditFSM.delta)
+@admin_router.message(UserEditFSM.delta)
 async def a_users_delta(message: Message, state: FSMContext):
     data = await state.get_data()
     try:
@@ -913,17 +3272,14 @@ async def a_users_delta(message: Message, state: FSMContext):
         await message.answer("Нужна цифра, пример: -50 или 200")
         return
     uid = data["uid"]
-    cur.execute("UPDATE users SET balance = balance + ? WHERE tg_id=?", (delta, uid))
-    conn.commit()
+    ok = await user_repo.add_balance(uid, delta, message.from_user.id)
     await state.clear()
-    await message.answer("Готово.")
+    await message.answer("Готово." if ok else "Пользователь не найден.")
 
 
 # Unknown admin callback router
-@router.callback_query(F.data == "admin")
+@admin_router.callback_query(F.data == "admin")
 async def admin_back(cb: CallbackQuery):
-    if not is_admin(cb.from_user.id):
-        return
     await admin_panel(cb.message)
     await cb.answer()
 
@@ -931,18 +3287,543 @@ async def admin_back(cb: CallbackQuery):
 # ====================
 # APP
 # ====================
-async def main():
+class WebhookServer:
+    """Приём апдейтов по HTTP.
+
+    Проверяет X-Telegram-Bot-Api-Secret-Token, обрабатывает апдейты
+    параллельно, но не больше max_inflight одновременно (сверх лимита ответ
+    придерживается — Telegram сам притормозит), при остановке дожидается
+    уже принятых апдейтов.
+    """
+
+    def __init__(self, dp: Dispatcher, bot: Bot, secret: str = "", max_inflight: int = WEBHOOK_MAX_INFLIGHT):
+        self.dp = dp
+        self.bot = bot
+        self.secret = secret
+        self._slots = asyncio.Semaphore(max_inflight)
+        self._inflight: set[asyncio.Task] = set()
+        self._closing = False
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if self.secret and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != self.secret:
+            return web.Response(status=401)
+        if self._closing:
+            return web.Response(status=503)  # Telegram повторит доставку
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except ValueError:
+            return web.Response(status=400)
+        await self._slots.acquire()
+        if self._closing:  # ждали слот, пока начался drain() — в него эта задача уже не попадёт
+            self._slots.release()
+            return web.Response(status=503)
+        task = asyncio.create_task(self._process(update))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+        return web.Response()
+
+    async def _process(self, update: Update):
+        try:
+            await self.dp.feed_update(self.bot, update)
+        except Exception:
+            logging.exception("Update %s failed", update.update_id)
+        finally:
+            self._slots.release()
+
+    async def drain(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT):
+        self._closing = True
+        if self._inflight:
+            logging.info("Draining %s in-flight updates", len(self._inflight))
+            await asyncio.wait(set(self._inflight), timeout=timeout)
+
+
+async def health(request: web.Request) -> web.Response:
+    return web.Response(text="ok")
+
+
+@metrics.collector
+async def _fsm_gauges():
+    return [("bot_fsm_states", "Пользователей в каждом состоянии FSM", "state", dict(await fsm_storage.state_counts()))]
+
+
+@metrics.collector
+async def _runtime_gauges():
+    outbox = await db.fetchall("SELECT status, COUNT(*) AS n FROM outbox WHERE status != 'sent' GROUP BY status")
+    mc = member_cache.stats()
+    return [
+        ("bot_outbox_messages", "Неотправленные уведомления outbox", "status", {r["status"]: r["n"] for r in outbox}),
+        ("bot_api_queued", "Запросы в очереди глобального лимита", None, {None: len(outbound._waiters)}),
+        ("bot_member_cache", "Кэш getChatMember", "kind", {k: mc[k] for k in ("size", "hits", "misses", "invalidations")}),
+        ("bot_throttled", "Колбэков отброшено антифлудом", None, {None: throttle.throttled}),
+        ("bot_broadcasts_running", "Активные рассылки", None, {None: len(_broadcast_jobs)}),
+        ("bot_verified_tasks", "Перепроверено подписок с запуска", "result", {"checked": verifier.checked, "left": verifier.left}),
+        ("bot_db_wal_bytes", "Размер WAL-файла", None, {None: db_maintenance.wal_size()}),
+        ("bot_db_freelist_pages", "Свободные страницы БД (на последней проверке)", None, {None: db_maintenance.last.get("freelist_pages", 0)}),
+    ]
+
+
+async def metrics_view(request: web.Request) -> web.Response:
+    return web.Response(text=await metrics.render(), content_type="text/plain", charset="utf-8")
+
+
+async def run_metrics_server() -> web.AppRunner:
+    """Отдельный /metrics для polling-режима."""
+    app = web.Application()
+    app.router.add_get("/", health)
+    app.router.add_get("/metrics", metrics_view)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, HOST, METRICS_PORT).start()
+    logging.info("Metrics on %s:%s/metrics", HOST, METRICS_PORT)
+    return runner
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot):
+    server = WebhookServer(dp, bot, WEBHOOK_SECRET)
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, server.handle)
+    app.router.add_get("/", health)
+    app.router.add_get("/metrics", metrics_view)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, HOST, PORT).start()
+    logging.info("Webhook server on %s:%s%s", HOST, PORT, WEBHOOK_PATH)
+
+    # Без WEBHOOK_URL вебхук не регистрируется — удобно для локальной
+    # проверки: curl -X POST localhost:8080/webhook -d @update.json
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=dp.resolve_used_update_types(),
+            max_connections=min(WEBHOOK_MAX_INFLIGHT, 100),
+        )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+    try:
+        await stop.wait()
+    finally:
+        await server.drain()
+        await runner.cleanup()
+
+
+# ====================
+# CLUSTER (supervisor + воркеры)
+# ====================
+# Супервизор принимает webhook и раскладывает апдейты по воркерам по хэшу
+# id пользователя: все апдейты одного юзера попадают в один процесс, так что
+# FSM-кэш, user_locks и антифлуд остаются локальными и согласованными.
+# Глобальный лимит Bot API выдаёт RateCoordinator в супервизоре; каталог
+# синхронизируется через settings.catalog_version (см. Catalog).
+def update_user_id(raw: dict) -> int:
+    """from.id / user.id / chat.id первого объекта апдейта, без разбора в pydantic.
+
+    chat_member/my_chat_member идут к шарду того, чьё членство изменилось, а не
+    того, кто изменил (админ кикнул юзера): member_cache живёт у шарда юзера.
+    """
+    for key, value in raw.items():
+        if key != "update_id" and isinstance(value, dict):
+            if key in ("chat_member", "my_chat_member"):
+                who = (value.get("new_chat_member") or {}).get("user") or value.get("from") or {}
+            else:
+                who = value.get("from") or value.get("user") or value.get("chat") or {}
+            return int(who.get("id") or 0)
+    return 0
+
+
+def shard_of(user_id: int, workers: int) -> int:
+    return zlib.crc32(str(user_id).encode()) % workers
+
+
+def _worker_socket(index: int) -> str:
+    return os.path.join(CLUSTER_DIR, f"worker-{index}.sock")
+
+
+COORDINATOR_SOCKET = os.path.join(CLUSTER_DIR, "coordinator.sock")
+
+
+class RateCoordinator:
+    """Общий на все процессы глобальный token bucket Bot API (живёт в супервизоре).
+
+    Воркеры берут токены пачками по RATE_LEASE, RetryAfter от любого воркера
+    ставит на паузу всех. Приоритеты Lane действуют внутри воркера.
+    """
+
+    def __init__(self, rate: float = OUTBOUND_RATE):
+        self.bucket = TokenBucket(rate, rate)
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, request: web.Request) -> web.Response:
+        want = max(1, int(request.query.get("n", "1")))
+        async with self._lock:  # FIFO между воркерами
+            await self.bucket.acquire()
+            granted = 1
+            while granted < want and self.bucket.try_take():
+                granted += 1
+        return web.json_response({"granted": granted})
+
+    async def pause(self, request: web.Request) -> web.Response:
+        self.bucket.pause(float(request.query["seconds"]))
+        return web.Response()
+
+
+class RemoteTokenBucket:
+    """Глобальный bucket воркера: тот же интерфейс, что у TokenBucket, токены — от RateCoordinator."""
+
+    def __init__(self, socket_path: str = COORDINATOR_SOCKET, lease: int = RATE_LEASE):
+        self.socket_path = socket_path
+        self.lease = lease
+        self.tokens = 0.0
+        self.paused_until = 0.0
+        self._session: ClientSession | None = None
+        self._pending: set[asyncio.Task] = set()
+
+    def _client(self) -> ClientSession:
+        if self._session is None:
+            self._session = ClientSession(connector=UnixConnector(path=self.socket_path))
+        return self._session
+
+    def try_take(self, n: float = 1) -> bool:
+        if time.monotonic() < self.paused_until or self.tokens < n:
+            return False
+        self.tokens -= n
+        return True
+
+    async def acquire(self, n: float = 1):
+        while not self.try_take(n):
+            wait = self.paused_until - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            try:
+                async with self._client().post("http://coordinator/acquire", params={"n": self.lease}) as resp:
+                    self.tokens += (await resp.json())["granted"]
+            except ClientError as e:
+                logging.warning("rate coordinator unavailable: %r", e)
+                await asyncio.sleep(1)
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        self.tokens = 0
+        task = asyncio.create_task(self._report_pause(seconds))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _report_pause(self, seconds: float):
+        try:
+            async with self._client().post("http://coordinator/pause", params={"seconds": seconds}):
+                pass
+        except ClientError as e:
+            logging.warning("rate coordinator unavailable: %r", e)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+
+async def run_worker(dp: Dispatcher, bot: Bot, index: int):
+    """Воркер: тот же WebhookServer, но на unix-сокете; апдейты присылает супервизор."""
+    server = WebhookServer(dp, bot, WEBHOOK_SECRET)
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, server.handle)
+    app.router.add_get("/metrics", metrics_view)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    path = _worker_socket(index)
+    if os.path.exists(path):
+        os.unlink(path)
+    await web.UnixSite(runner, path).start()
+    logging.info("Worker %s on %s", index, path)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    parent = os.getppid()
+
+    async def watch_parent():
+        # супервизор убит без SIGTERM воркерам — не остаёмся сиротами
+        while os.getppid() == parent:
+            await asyncio.sleep(1)
+        stop.set()
+
+    watcher = asyncio.create_task(watch_parent())
+    try:
+        await stop.wait()
+    finally:
+        watcher.cancel()
+        await server.drain()
+        await runner.cleanup()
+
+
+def _worker_entry(index: int, workers: int):
+    try:
+        asyncio.run(main("worker", worker=(index, workers)))
+    except KeyboardInterrupt:
+        pass
+
+
+class Supervisor:
+    """Приём webhook, маршрутизация по воркерам, перезапуск упавших."""
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.procs: list[multiprocessing.Process | None] = [None] * workers
+        self.sessions: list[ClientSession] = []
+        self._ctx = multiprocessing.get_context("spawn")  # fork + потоки БД = беда
+        self._closing = False
+
+    def spawn(self, index: int):
+        proc = self._ctx.Process(target=_worker_entry, args=(index, self.workers), name=f"bot-worker-{index}")
+        proc.start()
+        self.procs[index] = proc
+
+    async def watchdog(self):
+        while not self._closing:
+            await asyncio.sleep(1)
+            for i, proc in enumerate(self.procs):
+                if proc is not None and not proc.is_alive() and not self._closing:
+                    logging.warning("Worker %s exited with %s, restarting", i, proc.exitcode)
+                    self.spawn(i)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        if self._closing:
+            return web.Response(status=503)
+        body = await request.read()
+        try:
+            index = shard_of(update_user_id(json.loads(body)), self.workers)
+        except (ValueError, AttributeError):
+            return web.Response(status=400)
+        try:
+            async with self.sessions[index].post(
+                f"http://worker{WEBHOOK_PATH}",
+                data=body,
+                headers={"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": WEBHOOK_SECRET},
+            ) as resp:
+                return web.Response(status=resp.status)
+        except ClientError:
+            return web.Response(status=503)  # воркер перезапускается — Telegram повторит
+
+    async def worker_metrics(self, request: web.Request) -> web.Response:
+        index = int(request.match_info["worker"])
+        if not 0 <= index < self.workers:
+            raise web.HTTPNotFound()
+        try:
+            async with self.sessions[index].get("http://worker/metrics") as resp:
+                return web.Response(text=await resp.text(), content_type="text/plain", charset="utf-8")
+        except ClientError:
+            return web.Response(status=503)
+
+    async def stop_workers(self, timeout: float = WEBHOOK_DRAIN_TIMEOUT + 5):
+        for proc in self.procs:
+            if proc is not None and proc.is_alive():
+                proc.terminate()  # SIGTERM: воркер дорабатывает принятые апдейты
+        loop = asyncio.get_running_loop()
+        for proc in self.procs:
+            if proc is not None:
+                await loop.run_in_executor(None, proc.join, timeout)
+                if proc.is_alive():
+                    proc.kill()
+
+
+async def run_supervisor(workers: int = WORKERS):
+    if not BOT_TOKEN:
+        raise RuntimeError("BOT_TOKEN отсутствует в .env")
+    os.makedirs(CLUSTER_DIR, exist_ok=True)
+    init_schema()  # миграции — один раз до запуска воркеров, а не наперегонки в каждом
+    sup = Supervisor(workers)
+    coordinator = RateCoordinator()
+    coord_app = web.Application()
+    coord_app.router.add_post("/acquire", coordinator.acquire)
+    coord_app.router.add_post("/pause", coordinator.pause)
+    coord_runner = web.AppRunner(coord_app)
+    await coord_runner.setup()
+    if os.path.exists(COORDINATOR_SOCKET):
+        os.unlink(COORDINATOR_SOCKET)
+    await web.UnixSite(coord_runner, COORDINATOR_SOCKET).start()
+
+    for i in range(workers):
+        sup.spawn(i)
+    sup.sessions = [ClientSession(connector=UnixConnector(path=_worker_socket(i))) for i in range(workers)]
+    watchdog = asyncio.create_task(sup.watchdog())
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, sup.handle)
+    app.router.add_get("/", health)
+    app.router.add_get("/metrics/{worker}", sup.worker_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, HOST, PORT).start()
+    logging.info("Supervisor on %s:%s%s, %s workers", HOST, PORT, WEBHOOK_PATH, workers)
+
+    bot = Bot(BOT_TOKEN, parse_mode=None)
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=router.resolve_used_update_types(),
+            max_connections=min(WEBHOOK_MAX_INFLIGHT * workers, 100),
+        )
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        logging.info("Stopping %s workers", workers)
+        sup._closing = True
+        watchdog.cancel()
+        await runner.cleanup()  # новые апдейты → 503, дальше дорабатывают воркеры
+        await sup.stop_workers()
+        for session in sup.sessions:
+            await session.close()
+        await coord_runner.cleanup()
+        await bot.session.close()
+        db.close()
+
+
+async def on_startup(bot: Bot, primary: bool):
+    """Хук dp.startup: вся работа с БД начинается здесь — импорт модуля её не трогает."""
+    try:
+        init_schema()
+        if primary and await stats_repo.is_empty():
+            await stats_repo.rebuild()
+        await catalog.reload()
+        await admin_cache.reload()
+        if primary:
+            broadcast_watcher.start(bot)
+            outbox_worker.start(bot)
+            verifier.start(bot)
+            db_maintenance.start()
+    except BaseException:
+        # при сбое старта shutdown не вызывается — закрываем то, что успели открыть
+        await on_shutdown()
+        raise
+
+
+async def on_shutdown():
+    """Хук dp.shutdown: остановить фоновые задачи и закрыть БД.
+
+    FSM-хранилище (сброс на диск) Dispatcher закрывает сам — его хук
+    зарегистрирован раньше нашего и отрабатывает первым.
+    """
+    await broadcast_watcher.stop()
+    await outbox_worker.stop()
+    await verifier.stop()
+    await db_maintenance.stop()
+    if isinstance(outbound.global_bucket, RemoteTokenBucket):
+        await outbound.global_bucket.close()
+    db.close()
+
+
+async def main(mode: str = "polling", worker: tuple[int, int] | None = None):
+    """worker=(номер, всего) — процесс под супервизором, иначе одиночный бот."""
     if not BOT_TOKEN:
         raise RuntimeError("BOT_TOKEN отсутствует в .env")
     bot = Bot(BOT_TOKEN, parse_mode=None)
-    dp = Dispatcher()
+    bot.session.middleware(outbound)
+    # фоновые задачи с общим состоянием в БД (рассылки, outbox, перепроверка) — только в одном процессе
+    primary = worker is None or worker[0] == 0
+    dp = Dispatcher(storage=fsm_storage, events_isolation=KeyedEventIsolation(), primary=primary)
     dp.include_router(router)
-    await dp.start_polling(bot)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    if worker:
+        outbound.global_bucket = RemoteTokenBucket()
+        # общий антифлуд делится поровну: юзеры распределены по воркерам равномерно
+        g = throttle.global_bucket
+        throttle.global_bucket = TokenBucket(g.rate / worker[1], max(1.0, g.capacity / worker[1]))
+    if mode == "polling":
+        metrics_runner = await run_metrics_server() if METRICS_PORT else None
+        try:
+            # startup/shutdown вызывает сам start_polling;
+            # chat_member нужно запрашивать явно, иначе Telegram его не присылает
+            await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        finally:
+            if metrics_runner:
+                await metrics_runner.cleanup()
+        return
+    await dp.emit_startup(bot=bot, **dp.workflow_data)
+    try:
+        if mode == "worker":
+            await run_worker(dp, bot, worker[0])
+        else:
+            await run_webhook(dp, bot)
+    finally:
+        # как в start_polling: сначала shutdown-хуки (им ещё нужна сессия), потом закрываем её
+        await dp.emit_shutdown(bot=bot, **dp.workflow_data)
+        await bot.session.close()
+
+
+async def rebuild_stats():
+    try:
+        init_schema()
+        await stats_repo.rebuild()
+    finally:
+        db.close()
+    logging.info("stats_counters rebuilt")
+
+
+def vacuum_db(path: str = DB_PATH):
+    """Перевести базу в auto_vacuum=INCREMENTAL и ужать целиком (VACUUM). Только при остановленном боте."""
+    init_schema(path)
+    before = os.path.getsize(path)
+    started = time.perf_counter()
+    with closing(sqlite3.connect(path, timeout=30, isolation_level=None)) as c:
+        c.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        c.execute("VACUUM")
+        c.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    logging.info(
+        "VACUUM done in %.1fs: %.1f → %.1f MiB", time.perf_counter() - started, before / 2**20, os.path.getsize(path) / 2**20
+    )
+
+
+async def reconcile_ledger(tg_id: int | None = None, full: bool = False) -> bool:
+    try:
+        init_schema()
+        if full:
+            await ledger_repo.reset_checkpoints()
+        started = time.perf_counter()
+        report = await ledger_repo.reconcile(tg_id)
+    finally:
+        db.close()
+    logging.info("Ledger reconciled in %.2fs: %s", time.perf_counter() - started, json.dumps(report, ensure_ascii=False))
+    return not report["mismatches"] and report.get("ledger_total") == report.get("balance_total")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TG Task Bot")
+    parser.add_argument("--mode", choices=["polling", "webhook", "supervisor"], default=os.getenv("BOT_MODE", "polling"))
+    parser.add_argument("--workers", type=int, default=WORKERS, help="процессов в режиме supervisor")
+    parser.add_argument("--rebuild-stats", action="store_true", help="пересчитать счётчики статистики и выйти")
+    parser.add_argument("--reconcile", action="store_true", help="сверить журнал с балансами (с прошлой контрольной точки) и выйти")
+    parser.add_argument("--reconcile-user", type=int, metavar="TG_ID", help="сверить одного пользователя")
+    parser.add_argument("--full", action="store_true", help="с --reconcile: сверять с начала журнала")
+    parser.add_argument("--vacuum", action="store_true", help="включить incremental vacuum на старой базе (VACUUM) и выйти")
+    args = parser.parse_args()
+    if args.reconcile or args.reconcile_user:
+        if not asyncio.run(reconcile_ledger(args.reconcile_user, args.full)):
+            raise SystemExit("ledger mismatch")
+        raise SystemExit(0)
     try:
-        asyncio.run(main())
+        if args.vacuum:
+            vacuum_db()
+        elif args.rebuild_stats:
+            asyncio.run(rebuild_stats())
+        elif args.mode == "supervisor":
+            asyncio.run(run_supervisor(args.workers))
+        else:
+            asyncio.run(main(args.mode))
     except (KeyboardInterrupt, SystemExit):
         logging.info("Bot stopped")
 
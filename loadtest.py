@@ -0,0 +1,339 @@
+"""
+Нагрузочный прогон бота: синтетические апдейты → настоящий router/Dispatcher.
+
+Апдейты подаются через dp.feed_update (как их отдаёт webhook-сервер), вместо
+Telegram — локальная фейковая сессия с задержкой и случайными 429. Всё
+остальное настоящее: middlewares, SQLite (во временном каталоге), кэши,
+OutboundScheduler.
+
+Сценарии:
+    start      — «шторм» /start от новых пользователей
+    task_check — каждый пользователь жмёт «Проверить» несколько раз подряд
+    broadcast  — рассылка на N пользователей (run_broadcast целиком)
+
+Глобальный лимит исходящих поднят до --api-rate: настоящий Telegram даёт ~30 msg/s,
+здесь меряется накладная стоимость самого бота, а не лимит Telegram. По той же
+причине общий антифлуд колбэков (THROTTLE_GLOBAL) поднят до --throttle-rate;
+per-user правила остаются. updates/s считается только по апдейтам, дошедшим
+до хэндлеров, — отбитые антифлудом выводятся отдельно.
+
+Результаты дописываются в loadtest_results.jsonl и сравниваются с прошлым
+прогоном того же сценария с теми же параметрами.
+
+Запуск:
+    python loadtest.py                               # все сценарии
+    python loadtest.py start task_check -n 2000
+    python loadtest.py broadcast --broadcast-users 100000 --fail-on-regression
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+from aiogram import BaseMiddleware, Bot, Dispatcher
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import AnswerCallbackQuery, EditMessageText, GetChatMember, GetMe, SendMessage
+from aiogram.types import CallbackQuery, Chat, ChatMemberLeft, ChatMemberMember, Message, Update, User
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+OWNER_ID = 1
+SPONSOR_CHAT = -1001000000001
+TASK_CHAT = -1001000000002
+SCENARIOS = ("start", "task_check", "broadcast")
+
+
+class FakeTelegram(BaseSession):
+    """Bot API без сети: задержка ~latency_ms (±50%), 429 с вероятностью p429 на отправку сообщений."""
+
+    def __init__(self, latency_ms: float, p429: float, member_pct: int):
+        super().__init__()
+        self.latency = latency_ms / 1000
+        self.p429 = p429
+        self.member_pct = member_pct
+        self.calls = 0
+        self.rejected = 0
+        self._ids = itertools.count(1)
+
+    async def make_request(self, bot, method, timeout=None):
+        self.calls += 1
+        await asyncio.sleep(self.latency * random.uniform(0.5, 1.5))
+        if isinstance(method, (SendMessage, EditMessageText)):
+            if random.random() < self.p429:
+                self.rejected += 1
+                raise TelegramRetryAfter(method=method, message="Too Many Requests: retry after 1", retry_after=1)
+            chat_id = method.chat_id if isinstance(method.chat_id, int) else 0
+            return Message(
+                message_id=next(self._ids), date=datetime.now(), chat=Chat(id=chat_id, type="private"), text=method.text
+            )
+        if isinstance(method, GetChatMember):
+            user = User(id=method.user_id, is_bot=False, first_name="u")
+            if method.user_id % 100 < self.member_pct:
+                return ChatMemberMember(user=user)
+            return ChatMemberLeft(user=user)
+        if isinstance(method, GetMe):
+            return User(id=42, is_bot=True, first_name="bot", username="loadtest_bot")
+        if isinstance(method, AnswerCallbackQuery):
+            return True
+        return True
+
+    async def close(self):
+        pass
+
+    async def stream_content(self, *args, **kwargs):
+        yield b""
+
+
+class HandlerProbe(BaseMiddleware):
+    """Сырые латентности по хэндлерам — для p50/p99 (гистограммы /metrics грубее)."""
+
+    def __init__(self):
+        self.samples: dict[str, list[float]] = {}
+
+    async def __call__(self, handler, event, data):
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            self.samples.setdefault(data["handler"].callback.__name__, []).append(time.perf_counter() - started)
+
+
+_update_ids = itertools.count(1)
+
+
+def message_update(uid: int, text: str) -> Update:
+    user = User(id=uid, is_bot=False, first_name="u")
+    msg = Message(message_id=next(_update_ids), date=datetime.now(), chat=Chat(id=uid, type="private"), from_user=user, text=text)
+    return Update(update_id=next(_update_ids), message=msg)
+
+
+def callback_update(uid: int, data: str) -> Update:
+    msg = Message(
+        message_id=1, date=datetime.now(), chat=Chat(id=uid, type="private"),
+        from_user=User(id=42, is_bot=True, first_name="bot"), text="…",
+    )
+    cb = CallbackQuery(
+        id=str(next(_update_ids)), from_user=User(id=uid, is_bot=False, first_name="u"),
+        chat_instance="lt", message=msg, data=data,
+    )
+    return Update(update_id=next(_update_ids), callback_query=cb)
+
+
+def percentiles(samples: list[float]) -> dict:
+    s = sorted(samples)
+    return {
+        "n": len(s),
+        "p50_ms": round(statistics.median(s) * 1000, 3),
+        "p99_ms": round(s[min(len(s) - 1, int(len(s) * 0.99))] * 1000, 3),
+    }
+
+
+class Harness:
+    def __init__(self, bot_module, args):
+        self.B = bot_module
+        self.args = args
+        self.session = FakeTelegram(args.latency_ms, args.p429, args.member_pct)
+        self.bot = Bot("42:LOADTEST", session=self.session)
+        self.bot.session.middleware(self.B.outbound)
+        self.B.outbound.global_bucket = self.B.TokenBucket(args.api_rate, args.api_rate)
+        self.B.throttle.global_bucket = self.B.TokenBucket(args.throttle_rate, args.throttle_rate)
+        # primary=False: без фоновых outbox/перепроверки, сценарии запускают что нужно сами
+        self.dp = Dispatcher(storage=self.B.fsm_storage, events_isolation=self.B.KeyedEventIsolation(), primary=False)
+        self.dp.include_router(self.B.router)
+        self.dp.startup.register(self.B.on_startup)
+        self.dp.shutdown.register(self.B.on_shutdown)
+        self.probe = HandlerProbe()
+        for observer in (self.B.router.message, self.B.router.callback_query):
+            observer.middleware(self.probe)
+        self.task_id: int | None = None
+        self._next_uid = itertools.count(10_000_000, 1)
+
+    async def setup(self):
+        await self.dp.emit_startup(bot=self.bot, **self.dp.workflow_data)
+        await self.B.sponsor_repo.upsert(SPONSOR_CHAT, "loadtest_sponsor", "Sponsor")
+        await self.B.task_repo.add_subscribe("Load task", 10, TASK_CHAT, "https://t.me/loadtest_task")
+        await self.B.catalog.reload()
+        self.task_id = next(iter(self.B.catalog.tasks))
+
+    def new_users(self, n: int) -> list[int]:
+        return [next(self._next_uid) for _ in range(n)]
+
+    async def feed(self, updates: list[Update]) -> float:
+        """Скормить апдейты с ограничением параллельности (как WEBHOOK_MAX_INFLIGHT), вернуть секунды."""
+        sem = asyncio.Semaphore(self.args.concurrency)
+
+        async def one(update: Update):
+            async with sem:
+                await self.dp.feed_update(self.bot, update)
+
+        self.probe.samples.clear()
+        started = time.perf_counter()
+        await asyncio.gather(*(one(u) for u in updates))
+        return time.perf_counter() - started
+
+    def report(self, updates: int, elapsed: float, throttled: int = 0, **extra) -> dict:
+        """updates_s — по обработанным апдейтам: пустой cb.answer() антифлуда в неё не входит."""
+        return {
+            "updates_s": round((updates - throttled) / elapsed, 1),
+            "elapsed_s": round(elapsed, 3),
+            "handled": updates - throttled,
+            "throttled": throttled,
+            "handlers": {name: percentiles(s) for name, s in sorted(self.probe.samples.items())},
+            **extra,
+        }
+
+    async def scenario_start(self) -> dict:
+        updates = [message_update(uid, "/start") for uid in self.new_users(self.args.n)]
+        elapsed = await self.feed(updates)
+        return self.report(len(updates), elapsed)
+
+    async def scenario_task_check(self) -> dict:
+        users = self.new_users(self.args.n)
+        # пользователи уже есть в базе — меряем саму проверку, а не регистрацию
+        await self.feed([message_update(uid, "/start") for uid in users])
+        updates = [callback_update(uid, f"task_check:{self.task_id}") for uid in users for _ in range(self.args.taps)]
+        random.shuffle(updates)
+        paid_before = (await self.B.stats_repo.summary())["total"].get("tasks_done", 0)
+        throttled_before = self.B.throttle.throttled
+        elapsed = await self.feed(updates)
+        paid = (await self.B.stats_repo.summary())["total"].get("tasks_done", 0) - paid_before
+        return self.report(len(updates), elapsed, credited=paid, throttled=self.B.throttle.throttled - throttled_before)
+
+    async def scenario_broadcast(self) -> dict:
+        n = self.args.broadcast_users
+        first = next(self._next_uid)
+        self._next_uid = itertools.count(first + n)
+
+        def _insert(c):
+            c.executemany(
+                "INSERT OR IGNORE INTO users (tg_id, username, first_name) VALUES (?, ?, 'lt')",
+                ((uid, f"u{uid}") for uid in range(first, first + n)),
+            )
+
+        await self.B.db.write(_insert)
+        await self.B.db.execute("UPDATE broadcasts SET status='done' WHERE status='running'")
+        bc_id = await self.B.broadcast_repo.create("loadtest broadcast", 0, 0)
+        retry_after = sum(self.B.outbound.retry_after.values())
+        started = time.perf_counter()
+        await self.B.run_broadcast(self.bot, bc_id)
+        elapsed = time.perf_counter() - started
+        bc = await self.B.broadcast_repo.get(bc_id)
+        return {
+            "messages_s": round(bc["sent"] / elapsed, 1),
+            "elapsed_s": round(elapsed, 3),
+            "sent": bc["sent"],
+            "failed": bc["failed"],
+            "retry_after": sum(self.B.outbound.retry_after.values()) - retry_after,
+        }
+
+
+def git_rev() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=HERE, text=True).strip()
+    except Exception:
+        return "unknown"
+
+
+def load_previous(path: str) -> list[dict]:
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare(prev: dict | None, cur: dict, tolerance: float) -> list[str]:
+    """Регрессии: пропускная способность упала или p99 вырос больше чем на tolerance."""
+    if prev is None:
+        return []
+    problems = []
+    for key in ("updates_s", "messages_s"):
+        if key in cur and key in prev["result"] and cur[key] < prev["result"][key] * (1 - tolerance):
+            problems.append(f"{key}: {prev['result'][key]} → {cur[key]}")
+    for name, h in cur.get("handlers", {}).items():
+        old = prev["result"].get("handlers", {}).get(name)
+        if old and h["p99_ms"] > old["p99_ms"] * (1 + tolerance):
+            problems.append(f"{name} p99: {old['p99_ms']} → {h['p99_ms']} ms")
+    return problems
+
+
+def print_result(name: str, res: dict, prev: dict | None):
+    since = f" (прошлый прогон: {prev['rev']}, {prev['ts']})" if prev else ""
+    head = f"{res['updates_s']} updates/s" if "updates_s" in res else f"{res['messages_s']} msg/s"
+    print(f"\n== {name}: {head}, {res['elapsed_s']} s{since}")
+    for key in ("handled", "throttled", "credited", "sent", "failed", "retry_after"):
+        if key in res:
+            print(f"   {key}: {res[key]}")
+    if res.get("handlers"):
+        print(f"   {'handler':<24}{'n':>8}{'p50 ms':>10}{'p99 ms':>10}")
+        for h, p in res["handlers"].items():
+            print(f"   {h:<24}{p['n']:>8}{p['p50_ms']:>10.2f}{p['p99_ms']:>10.2f}")
+
+
+async def run(args) -> int:
+    with tempfile.TemporaryDirectory() as tmp:
+        # bot.py открывает bot.db относительно cwd и читает .env при импорте
+        os.environ["OWNER_ID"] = str(OWNER_ID)
+        os.environ.setdefault("BOT_TOKEN", "42:LOADTEST")
+        os.chdir(tmp)
+        sys.path.insert(0, HERE)
+        import bot
+
+        logging.getLogger().setLevel(logging.WARNING)
+        h = Harness(bot, args)
+        history = load_previous(args.results)
+        params = {k: v for k, v in vars(args).items() if k not in ("scenarios", "results", "fail_on_regression", "tolerance")}
+        regressions = []
+        try:
+            await h.setup()
+            for name in args.scenarios:
+                res = await getattr(h, f"scenario_{name}")()
+                prev = next((r for r in reversed(history) if r["scenario"] == name and r["params"] == params), None)
+                print_result(name, res, prev)
+                for problem in compare(prev, res, args.tolerance):
+                    print(f"   ⚠ регрессия: {problem}")
+                    regressions.append(problem)
+                with open(args.results, "a", encoding="utf-8") as f:
+                    record = {"ts": datetime.now().isoformat(timespec="seconds"), "rev": git_rev(), "scenario": name, "params": params, "result": res}
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        finally:
+            await h.dp.emit_shutdown(bot=h.bot, **h.dp.workflow_data)
+            os.chdir(HERE)
+        print(f"\nFake API: {h.session.calls} calls, 429: {h.session.rejected}; результаты → {args.results}")
+    return 1 if regressions and args.fail_on_regression else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("scenarios", nargs="*", help=f"{', '.join(SCENARIOS)}; по умолчанию — все")
+    parser.add_argument("-n", type=int, default=5000, help="пользователей в сценариях start и task_check")
+    parser.add_argument("-c", "--concurrency", type=int, default=64, help="апдейтов в обработке одновременно")
+    parser.add_argument("--taps", type=int, default=3, help="нажатий «Проверить» на пользователя")
+    parser.add_argument("--broadcast-users", type=int, default=100_000)
+    parser.add_argument("--latency-ms", type=float, default=30, help="средняя задержка фейкового Bot API")
+    parser.add_argument("--p429", type=float, default=0.0001, help="вероятность 429 на отправку сообщения")
+    parser.add_argument("--member-pct", type=int, default=80, help="процент пользователей, подписанных на каналы")
+    parser.add_argument("--api-rate", type=float, default=2000, help="глобальный лимит исходящих, msg/s")
+    parser.add_argument("--throttle-rate", type=float, default=100_000, help="общий антифлуд колбэков, в сек (в боте — THROTTLE_GLOBAL)")
+    parser.add_argument("--results", default=os.path.join(HERE, "loadtest_results.jsonl"))
+    parser.add_argument("--tolerance", type=float, default=0.2, help="допустимое ухудшение (0.2 = 20%%)")
+    parser.add_argument("--fail-on-regression", action="store_true", help="код выхода 1 при регрессии")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"неизвестные сценарии: {', '.join(sorted(unknown))}")
+    args.scenarios = args.scenarios or list(SCENARIOS)
+    random.seed(0)
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    main()